@@ -0,0 +1,79 @@
+"""
+MarkdownSplitter 吞吐量测试 (MB/s)
+
+用法:
+    python benchmarks/bench_markdown_splitter.py                 # 生成约 20MB 的 10-K 风格 markdown
+    python benchmarks/bench_markdown_splitter.py --file 10k.md   # 使用真实的 markdown 文件
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chunks import get_operator
+
+def make_filing(size_mb: float, seed: int = 0) -> str:
+    """
+    生成 10-K 风格的 markdown: 多级标题、长段落、表格、少量公式和代码块
+    """
+    rng = random.Random(seed)
+    words = ("revenue net income segment operating expenses liabilities assets fiscal "
+             "year ended december consolidated statements cash flows shareholders equity "
+             "goodwill impairment deferred tax notes maturity interest rate risk").split()
+    target = int(size_mb * 1024 * 1024)
+    parts, size, item = [], 0, 0
+    while size < target:
+        item += 1
+        block = [f"# Item {item}. Part {item % 4}\n"]
+        for section in range(rng.randint(2, 5)):
+            block.append(f"## Section {item}.{section}\n")
+            for _ in range(rng.randint(3, 8)):
+                block.append(" ".join(rng.choices(words, k=rng.randint(40, 120))) + ".\n\n")
+            if rng.random() < 0.5:
+                block.append("### Table\n| Item | 2022 | 2023 |\n|---|---|---|\n")
+                block.extend(f"| {rng.choice(words)} | {rng.randint(1, 9999)} | {rng.randint(1, 9999)} |\n"
+                             for _ in range(rng.randint(5, 30)))
+            if rng.random() < 0.1:
+                block.append("$$\nEPS = \\frac{net\\ income}{shares}\n$$\n")
+            if rng.random() < 0.05:
+                block.append("```\nraw exhibit text\n```\n")
+            block.append("---\n")
+        text = "".join(block)
+        parts.append(text)
+        size += len(text.encode("utf-8"))
+    return "".join(parts)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", default=None, help="markdown 文件路径")
+    parser.add_argument("--size-mb", type=float, default=20.0, help="未指定文件时生成的文本大小")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = make_filing(args.size_mb)
+    size_mb = len(text.encode("utf-8")) / 1024 / 1024
+
+    splitter = get_operator("markdown-splitter")()
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        chunks = splitter.execute(text)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(json.dumps({
+        "benchmark": "markdown-splitter",
+        "size_mb": round(size_mb, 2),
+        "chunks": len(chunks),
+        "best_seconds": round(best, 4),
+        "mb_per_second": round(size_mb / best, 2),
+    }))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+各阶段与端到端的基准测试, 使用 stub_servers 中的本地替身服务, 不需要内部接口
+
+场景:
+    expand     查询扩展: 逐条 expand_query_stream vs aexpand_queries (abatch)
+    embedding  get_embedding 逐条请求 vs EmbeddingClient 批量请求
+    rerank     get_rerank 逐个查询 vs batch_rerank
+    chunk      已注册的分块算子吞吐 (MB/s)
+    e2e        data/FinQA/queries.jsonl: 查询扩展 -> 入库 -> 检索 -> rerank -> 生成
+
+用法:
+    python benchmarks/bench_pipeline.py                                  # 运行全部场景
+    python benchmarks/bench_pipeline.py --scenarios expand,embedding --latency-ms 50
+    python benchmarks/bench_pipeline.py --output results.json            # 结果同时写入文件
+输出为 JSON, 每个场景/变体一条记录, 可与之前的结果比较以发现性能回退
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from langchain_openai import ChatOpenAI
+from stub_servers import StubServer
+from bench_markdown_splitter import make_filing
+from utils import iter_jsonl, JsonlWriter
+
+QUERIES_PATH = os.path.join(ROOT, "data", "FinQA", "queries.jsonl")
+
+def load_queries(n: int):
+    queries = list(iter_jsonl(QUERIES_PATH))
+    # 查询不足时循环使用, 并改写 _id 避免重复
+    return [dict(query, _id=f"{query['_id']}-{i // len(queries)}")
+            for i, query in zip(range(n), itertools.cycle(queries))]
+
+def make_docs(n_docs: int, seed: int = 0):
+    """
+    将生成的 10-K 文本按 Item 切分为文档
+    """
+    text = make_filing(max(0.05, n_docs * 0.004), seed=seed)
+    parts = [part for part in text.split("# Item ") if part.strip()]
+    return [{"_id": f"d{i}", "title": f"Item {part.split('.', 1)[0]}", "text": f"# Item {part}"}
+            for i, part in enumerate(parts[:n_docs])]
+
+def make_llm(server: StubServer) -> ChatOpenAI:
+    return ChatOpenAI(api_key="bench", base_url=f"{server.url}/v1", model_name="stub")
+
+def record(results, scenario, variant, items, seconds, server=None, before=None, **extra):
+    result = {"benchmark": scenario, "variant": variant, "items": items,
+              "seconds": round(seconds, 4),
+              "items_per_second": round(items / seconds, 2) if seconds > 0 else None}
+    if server is not None:
+        result["requests"] = {key: value - (before or {}).get(key, 0) for key, value in server.stats.items()
+                              if value - (before or {}).get(key, 0)}
+    result.update(extra)
+    results.append(result)
+    print(json.dumps(result, ensure_ascii=False), file=sys.stderr)
+
+def timed(server, fn):
+    before = dict(server.stats) if server is not None else None
+    start = time.perf_counter()
+    value = fn()
+    return value, time.perf_counter() - start, before
+
+# ===== 场景 =====
+def bench_expand(server, args, results):
+    from pre_retrueval import expand_query_stream, aexpand_queries, load_prompt
+    llm = make_llm(server)
+    queries = load_queries(args.queries)
+    _, seconds, before = timed(server, lambda: [expand_query_stream(q, llm, "FinQA") for q in queries])
+    record(results, "expand", "sequential", len(queries), seconds, server, before)
+    prompt = load_prompt("FinQA")
+    _, seconds, before = timed(server, lambda: asyncio.run(
+        aexpand_queries(queries, llm, prompt, max_concurrency=args.concurrency)))
+    record(results, "expand", "abatch", len(queries), seconds, server, before, concurrency=args.concurrency)
+
+def bench_embedding(server, args, results):
+    from embedding import get_embedding, EmbeddingClient
+    texts = [q["text"] for q in load_queries(args.queries * 4)]
+    url = f"{server.url}/embeddings"
+    _, seconds, before = timed(server, lambda: [get_embedding(text, url, "bench") for text in texts])
+    record(results, "embedding", "get_embedding", len(texts), seconds, server, before)
+    with EmbeddingClient(url=url, api_key="bench", max_batch_size=64, pool_size=args.concurrency) as client:
+        _, seconds, before = timed(server, lambda: client.embed(texts))
+        record(results, "embedding", "EmbeddingClient", len(texts), seconds, server, before)
+        batches = [texts[i:i + 64] for i in range(0, len(texts), 64)]
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            _, seconds, before = timed(server, lambda: list(executor.map(client.embed, batches)))
+        record(results, "embedding", "EmbeddingClient-threads", len(texts), seconds, server, before,
+               concurrency=args.concurrency)
+
+def bench_rerank(server, args, results):
+    from rerank import get_rerank, batch_rerank
+    queries = [q["text"] for q in load_queries(args.queries)]
+    docs = [doc["text"][:2000] for doc in make_docs(args.candidates)]
+    pairs = [(query, docs) for query in queries]
+    url = f"{server.url}/rerank"
+    _, seconds, before = timed(server, lambda: [get_rerank(q, d, "bench", url, top_n=len(d)) for q, d in pairs])
+    record(results, "rerank", "get_rerank", len(pairs) * len(docs), seconds, server, before)
+    _, seconds, before = timed(server, lambda: batch_rerank(pairs, "bench", url, max_workers=args.concurrency))
+    record(results, "rerank", "batch_rerank", len(pairs) * len(docs), seconds, server, before,
+           concurrency=args.concurrency)
+
+def bench_chunk(server, args, results):
+    from chunks import get_operator
+    text = make_filing(args.chunk_mb)
+    size_mb = len(text.encode("utf-8")) / 1024 / 1024
+    operators = {
+        "markdown-splitter": {},
+        "langchain-length-based": {"chunk_size": 512, "chunk_overlap": 51},
+        "langchain-structure-based": {"chunk_size": 512, "chunk_overlap": 51},
+        "table-splitter": {"chunk_size": 512},
+    }
+    for name, kwargs in operators.items():
+        operator = get_operator(name)(**kwargs)
+        chunks, seconds, _ = timed(None, lambda: operator.execute(text))
+        record(results, "chunk", name, len(chunks), seconds, mb=round(size_mb, 2),
+               mb_per_second=round(size_mb / seconds, 2))
+
+def bench_e2e(server, args, results):
+    from pre_retrueval import pre_retrieve
+    from chunks import get_operator
+    from embedding import EmbeddingClient
+    from ingest import ingest_corpus
+    from vector_index import NumpyVectorIndex
+    from rerank import batch_rerank
+    from generation import generate_answers
+
+    llm = make_llm(server)
+    dataset_path = tempfile.mkdtemp(prefix="bench-e2e-")
+    subset = "FinQA"
+    try:
+        os.makedirs(os.path.join(dataset_path, subset))
+        queries = load_queries(args.queries)
+        with JsonlWriter(os.path.join(dataset_path, subset, "queries.jsonl")) as writer:
+            writer.write_all(queries)
+        with JsonlWriter(os.path.join(dataset_path, subset, "corpus.jsonl")) as writer:
+            writer.write_all(make_docs(args.docs))
+
+        stages = {}
+        start = time.perf_counter()
+        _, stages["pre_retrieve"], _ = timed(None, lambda: pre_retrieve(
+            dataset_path, llm, max_concurrency=args.concurrency, subsets=[subset], incremental=False))
+
+        client = EmbeddingClient(url=f"{server.url}/embeddings", api_key="bench", pool_size=args.concurrency)
+        store = NumpyVectorIndex(dimensions=client.dimensions)
+        operator = get_operator("langchain-structure-based")(chunk_size=512, chunk_overlap=51)
+        stats, stages["ingest"], _ = timed(None, lambda: ingest_corpus(
+            os.path.join(dataset_path, subset, "corpus_prep.jsonl"), operator, client, store,
+            embed_workers=args.concurrency))
+
+        expanded = list(iter_jsonl(os.path.join(dataset_path, subset, "expanded_queries.jsonl")))
+        def retrieve():
+            return store.search(client.embed([q["text"] for q in expanded]), top_k=args.candidates)
+        hits_list, stages["retrieve"], _ = timed(None, retrieve)
+
+        questions = [q["text"].split("\n\n", 1)[-1] for q in expanded]
+        scores_list, stages["rerank"], _ = timed(None, lambda: batch_rerank(
+            [(question, [hit["metadata"]["text"] for hit in hits]) for question, hits in zip(questions, hits_list)],
+            "bench", f"{server.url}/rerank", max_workers=args.concurrency))
+
+        answers, stages["generate"], _ = timed(None, lambda: generate_answers(
+            questions, hits_list, llm, subset, scores_list=scores_list, max_tokens=args.max_tokens,
+            max_concurrency=args.concurrency))
+        seconds = time.perf_counter() - start
+        client.close()
+        record(results, "e2e", "FinQA", len(queries), seconds, server,
+               stages={key: round(value, 4) for key, value in stages.items()},
+               chunks=stats["chunks"], answered=sum(answer is not None for answer in answers),
+               concurrency=args.concurrency)
+    finally:
+        shutil.rmtree(dataset_path, ignore_errors=True)
+
+SCENARIOS = {
+    "expand": bench_expand,
+    "embedding": bench_embedding,
+    "rerank": bench_rerank,
+    "chunk": bench_chunk,
+    "e2e": bench_e2e,
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔的场景列表")
+    parser.add_argument("--queries", type=int, default=100, help="使用的查询数量")
+    parser.add_argument("--docs", type=int, default=200, help="端到端场景的文档数量")
+    parser.add_argument("--candidates", type=int, default=20, help="每个查询的检索/rerank候选数")
+    parser.add_argument("--chunk-mb", type=float, default=5.0, help="分块场景的文本大小")
+    parser.add_argument("--concurrency", type=int, default=8, help="客户端并发数")
+    parser.add_argument("--max-tokens", type=int, default=3000, help="生成阶段的提示词预算")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="替身服务每个请求的固定延迟")
+    parser.add_argument("--per-item-ms", type=float, default=0.5, help="替身服务每个条目的延迟")
+    parser.add_argument("--server-concurrency", type=int, default=16, help="替身服务同时处理的请求数")
+    parser.add_argument("--output", default=None, help="结果 JSON 文件路径")
+    args = parser.parse_args()
+
+    # prompt.json 通过相对路径读取
+    os.chdir(ROOT)
+    results = []
+    with StubServer(args.latency_ms, args.per_item_ms, args.server_concurrency) as server:
+        for name in args.scenarios.split(","):
+            SCENARIOS[name.strip()](server, args, results)
+    report = {"config": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
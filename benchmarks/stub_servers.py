@@ -0,0 +1,193 @@
+"""
+本地替身服务, 模拟 embedding / rerank / OpenAI 兼容 chat 接口, 用于离线基准测试
+
+    POST /embeddings, /v1/embeddings          -> {"data": [{"index", "embedding"}], ...}
+    POST /rerank, /v1/rerank                  -> {"results": [{"index", "relevance_score"}], ...}
+    POST /chat/completions, /v1/chat/completions -> OpenAI chat completion
+
+延迟模型: 每个请求耗时 latency_ms + per_item_ms * 条目数 (文本数 / 文档数 / 输出token数)
+吞吐模型: 同时处理的请求数不超过 max_concurrency, 超出的请求排队, 模拟服务端的并发上限
+输出是确定性的: 向量与分数由文本的哈希决定, 多次运行结果一致
+
+用法:
+    with StubServer(latency_ms=20, per_item_ms=1, max_concurrency=8) as server:
+        client = EmbeddingClient(url=f"{server.url}/embeddings", api_key="bench")
+"""
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def fake_embedding(text: str, dimensions: int) -> list:
+    vector = np.random.default_rng(_seed(text)).standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def fake_relevance(query: str, document: str) -> float:
+    """
+    词重合度, 让 rerank 结果与文本相关而不是随机的
+    """
+    q = set(_WORD.findall(query.lower()))
+    d = set(_WORD.findall(document.lower()))
+    if not q or not d:
+        return -10.0
+    return 10.0 * len(q & d) / len(q) - 5.0
+
+def fake_completion(prompt: str) -> str:
+    """
+    关键词提取提示返回关键词, map 提示返回摘录, 其余返回一个简短答案
+    """
+    question = prompt.rsplit("# Question", 1)[-1] if "# Question" in prompt else prompt.rsplit("\n", 2)[-1]
+    words = [w for w, _ in Counter(_WORD.findall(question.lower())).most_common(3)]
+    if "Extract keywords" in prompt:
+        return ", ".join(words) or "revenue"
+    if "reply exactly: NONE" in prompt:
+        return f"notes: {' '.join(words)}"
+    return "42"
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认的 backlog (5) 在高并发下会拒绝连接
+    request_queue_size = 256
+
+class StubServer:
+    def __init__(self, latency_ms: float = 20.0, per_item_ms: float = 0.5, max_concurrency: int = 8,
+                 dimensions: int = 1024, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param latency_ms: 每个请求的固定延迟
+        :param per_item_ms: 每个条目增加的延迟
+        :param max_concurrency: 服务端同时处理的请求数
+        :param dimensions: 未在请求中指定时的向量维度
+        :param port: 0 表示随机端口
+        """
+        self.latency_ms = latency_ms
+        self.per_item_ms = per_item_ms
+        self.max_concurrency = max_concurrency
+        self.dimensions = dimensions
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头与响应体分两次写出, keep-alive 连接上 Nagle 与延迟 ACK 会让每个请求多等约 40ms
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    return self._send(400, {"error": "invalid json"})
+                path = self.path.rstrip("/")
+                if path.endswith("/embeddings"):
+                    route, handle = "embeddings", stub._embeddings
+                elif path.endswith("/rerank"):
+                    route, handle = "rerank", stub._rerank
+                elif path.endswith("/chat/completions"):
+                    route, handle = "chat", stub._chat
+                else:
+                    return self._send(404, {"error": f"unknown route {self.path}"})
+                with stub._slots:
+                    result, items = handle(payload)
+                    time.sleep((stub.latency_ms + stub.per_item_ms * items) / 1000.0)
+                with stub._stats_lock:
+                    stub.stats[f"{route}_requests"] += 1
+                    stub.stats[f"{route}_items"] += items
+                self._send(200, result)
+
+            def _send(self, status, result):
+                data = json.dumps(result).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    # ===== 路由 =====
+    def _embeddings(self, payload):
+        texts = payload.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        dimensions = payload.get("dimensions") or self.dimensions
+        data = [{"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+                for i, text in enumerate(texts)]
+        return {"object": "list", "data": data, "model": payload.get("model", "stub")}, len(texts)
+
+    def _rerank(self, payload):
+        query, documents = payload.get("query", ""), payload.get("documents", [])
+        results = [{"index": i, "relevance_score": fake_relevance(query, document)}
+                   for i, document in enumerate(documents)]
+        results.sort(key=lambda item: item["relevance_score"], reverse=True)
+        top_n = payload.get("top_n") or len(results)
+        return {"results": results[:top_n], "model": payload.get("model", "stub")}, len(documents)
+
+    def _chat(self, payload):
+        prompt = "\n".join(str(message.get("content", "")) for message in payload.get("messages", []))
+        content = fake_completion(prompt)
+        prompt_tokens, completion_tokens = len(prompt) // 4 + 1, len(content) // 4 + 1
+        return {
+            "id": f"chatcmpl-{_seed(prompt):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }, completion_tokens
+
+    # ===== 生命周期 =====
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="启动本地替身服务")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--per-item-ms", type=float, default=0.5)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    args = parser.parse_args()
+    server = StubServer(args.latency_ms, args.per_item_ms, args.max_concurrency, port=args.port).start()
+    print(f"Stub server listening on {server.url}")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import logging
+import numpy as np
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+from vector_index import BaseVectorStore, _top_k
+import tracing
+
+logger = logging.getLogger(__name__)
+"""
+    基于关键词的稀疏检索
+    - 倒排表以 CSR 数组保存: indptr[term] .. indptr[term+1] 为该词的 (文档下标, 权重)
+    - 构建时预先计算 IDF 与 BM25 的文档侧权重, 查询时只需累加
+    - 持久化为 .npy 文件, 加载时通过 mmap 映射
+    - 与稠密检索的结果通过 Reciprocal Rank Fusion (RRF) 融合
+"""
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.'&][a-z0-9]+)*")
+STOPWORDS = frozenset("""
+    a an and are as at be by for from has have in is it its of on or that the this to was were what which
+    with how many much did does do
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def extract_keywords(expanded_query: str) -> List[str]:
+    """
+    从扩展后的查询中提取LLM生成的关键词
+    pre_retrueval 将关键词放在第一段, 以逗号分隔: "JPM, Segment, breakdown\n\n<原始查询>"
+    """
+    first = expanded_query.strip().split("\n\n", 1)[0]
+    return [keyword.strip() for keyword in first.split(",") if keyword.strip()]
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        """
+        :param k1: 词频饱和参数
+        :param b: 文档长度归一化参数
+        """
+        self.k1 = k1
+        self.b = b
+        self.vocab: Dict[str, int] = {}
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+        self.weights = np.empty(0, dtype=np.float32)
+        self.idf = np.empty(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict], k1: float = 1.5, b: float = 0.75,
+                     keep_metadata: bool = True) -> "BM25Index":
+        """
+        流式构建索引
+        :param records: 分块记录 {"id": ..., "text": ..., "metadata": {...}}, 如 ingest.iter_chunks 的输出
+        :param keep_metadata: 是否保存分块的 metadata, 融合检索结果时使用
+        """
+        index = cls(k1=k1, b=b)
+        vocab = index.vocab
+        term_ids, doc_idx, tfs = array("i"), array("i"), array("f")
+        doc_len = array("f")
+        for record in records:
+            counts = Counter(tokenize(record["text"]))
+            doc = len(index.ids)
+            index.ids.append(record["id"])
+            index.metadata.append(record.get("metadata", {}) if keep_metadata else {})
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                term_id = vocab.get(term)
+                if term_id is None:
+                    term_id = vocab[term] = len(vocab)
+                term_ids.append(term_id)
+                doc_idx.append(doc)
+                tfs.append(tf)
+        index._finalize(np.frombuffer(term_ids, dtype=np.int32),
+                        np.frombuffer(doc_idx, dtype=np.int32),
+                        np.frombuffer(tfs, dtype=np.float32),
+                        np.frombuffer(doc_len, dtype=np.float32))
+        logger.info(f"BM25 index built: {len(index.ids)} chunks, {len(vocab)} terms, "
+                    f"{len(index.postings)} postings.")
+        return index
+
+    def _finalize(self, term_ids: np.ndarray, doc_idx: np.ndarray, tfs: np.ndarray, doc_len: np.ndarray):
+        """
+        按词排序得到 CSR 倒排表, 并预先计算每个 posting 的 BM25 权重
+        """
+        n_docs, n_terms = len(doc_len), len(self.vocab)
+        order = np.argsort(term_ids, kind="stable")
+        df = np.bincount(term_ids, minlength=n_terms)
+        self.indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=self.indptr[1:])
+        self.postings = doc_idx[order]
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        tf = tfs[order]
+        avgdl = float(doc_len.mean()) if n_docs else 1.0
+        norm = self.k1 * (1.0 - self.b + self.b * doc_len[self.postings] / max(avgdl, 1e-6))
+        idf = np.repeat(self.idf, df)
+        self.weights = (idf * tf * (self.k1 + 1.0) / (tf + norm)).astype(np.float32)
+
+    # ===== 检索 =====
+    def _term_ids(self, query: Union[str, Sequence[str]]) -> List[int]:
+        if isinstance(query, str):
+            query = [query]
+        terms = {token for keyword in query for token in tokenize(keyword)}
+        return [self.vocab[term] for term in terms if term in self.vocab]
+
+    def score(self, query: Union[str, Sequence[str]]):
+        """
+        :param query: 查询文本, 或关键词列表 (多词关键词按词袋处理)
+        :return: (命中的文档下标, 分数)
+        """
+        term_ids = self._term_ids(query)
+        if not term_ids:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        docs = np.concatenate([self.postings[self.indptr[t]:self.indptr[t + 1]] for t in term_ids])
+        weights = np.concatenate([self.weights[self.indptr[t]:self.indptr[t + 1]] for t in term_ids])
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        return candidates, np.bincount(inverse, weights=weights).astype(np.float32)
+
+    @tracing.traced("vector_search", backend="bm25")
+    def search(self, queries: Sequence[Union[str, Sequence[str]]], top_k: int = 10) -> List[List[dict]]:
+        """
+        :param queries: 查询列表, 每个查询为文本或关键词列表
+        :return: 与 BaseVectorStore.search 相同的格式
+        """
+        results = []
+        for query in queries:
+            candidates, scores = self.score(query)
+            idx, top = _top_k(scores[None, :], top_k)
+            results.append([{"id": self.ids[candidates[i]], "score": float(s),
+                             "metadata": self.metadata[candidates[i]]}
+                            for i, s in zip(idx[0], top[0])])
+        return results
+
+    # ===== 持久化 =====
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in ("indptr", "postings", "weights", "idf"):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        terms = [None] * len(self.vocab)
+        for term, term_id in self.vocab.items():
+            terms[term_id] = term
+        with open(os.path.join(path, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "terms": terms,
+                       "ids": self.ids, "metadata": self.metadata}, f, ensure_ascii=False)
+        logger.info(f"BM25 index saved to {path} ({len(self.ids)} chunks).")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "BM25Index":
+        if not os.path.exists(os.path.join(path, "bm25.json")):
+            logger.error(f"BM25 index {path} does not exist.")
+            raise FileNotFoundError(f"BM25 index {path} does not exist.")
+        with open(os.path.join(path, "bm25.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(k1=meta["k1"], b=meta["b"])
+        index.vocab = {term: i for i, term in enumerate(meta["terms"])}
+        index.ids = meta["ids"]
+        index.metadata = meta["metadata"]
+        for name in ("indptr", "postings", "weights", "idf"):
+            setattr(index, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None))
+        return index
+
+# ===== 融合 =====
+def reciprocal_rank_fusion(result_lists: Sequence[List[dict]], k: int = 60,
+                           top_k: Optional[int] = None,
+                           weights: Optional[Sequence[float]] = None) -> List[dict]:
+    """
+    RRF: score(d) = sum_i w_i / (k + rank_i(d)), 只依赖排名, 不需要对不同检索器的分数做归一化
+    :param result_lists: 同一查询在多个检索器中的结果, 每个按分数降序
+    :param k: 平滑常数
+    :param weights: 每个检索器的权重, 默认均为1
+    :return: [{"id", "score", "metadata"}, ...], 按融合分数降序
+    """
+    weights = weights or [1.0] * len(result_lists)
+    fused: Dict[str, dict] = {}
+    for hits, weight in zip(result_lists, weights):
+        for rank, hit in enumerate(hits, start=1):
+            entry = fused.get(hit["id"])
+            if entry is None:
+                entry = fused[hit["id"]] = {"id": hit["id"], "score": 0.0, "metadata": hit.get("metadata", {})}
+            entry["score"] += weight / (k + rank)
+    ranked = sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)
+    return ranked[:top_k] if top_k else ranked
+
+def hybrid_search(expanded_queries: Sequence[str],
+                  query_vectors: np.ndarray,
+                  vector_store: BaseVectorStore,
+                  bm25: BM25Index,
+                  top_k: int = 50,
+                  dense_k: int = 100,
+                  sparse_k: int = 100,
+                  rrf_k: int = 60,
+                  weights: Optional[Sequence[float]] = None) -> List[List[dict]]:
+    """
+    稠密检索 + BM25关键词检索, RRF融合后作为 rerank 的候选集
+    :param expanded_queries: pre_retrueval 扩展后的查询文本, 第一段为关键词
+    :param query_vectors: 查询的 embedding, 与 expanded_queries 一一对应
+    :param weights: (稠密, 稀疏) 的 RRF 权重
+    """
+    dense = vector_store.search(query_vectors, top_k=dense_k)
+    sparse = bm25.search([extract_keywords(query) or query for query in expanded_queries], top_k=sparse_k)
+    return [reciprocal_rank_fusion([d, s], k=rrf_k, top_k=top_k, weights=weights)
+            for d, s in zip(dense, sparse)]
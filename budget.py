@@ -0,0 +1,68 @@
+import time
+import logging
+import threading
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+"""
+    进程内共享的请求预算
+    多个子集并发运行时, 对同一服务 (embedding / rerank) 的请求共用一个预算:
+        - 并发上限: 同时在途的请求数
+        - 速率上限: 令牌桶, 每秒最多 requests_per_second 个请求, 允许 burst 个突发
+    LLM 请求使用 langchain 的 InMemoryRateLimiter, 并发上限按子集数分摊到 abatch 的 max_concurrency
+"""
+
+class RateBudget:
+    def __init__(self, max_concurrency: int = 8, requests_per_second: Optional[float] = None,
+                 burst: Optional[int] = None, name: str = "requests"):
+        """
+        :param max_concurrency: 最大在途请求数
+        :param requests_per_second: 每秒请求数上限, None 表示不限速
+        :param burst: 令牌桶容量, 默认等于 max_concurrency
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.burst = burst or max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self.calls = 0
+        self.wait_seconds = 0.0
+
+    def _take_token(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.requests_per_second)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.requests_per_second
+            time.sleep(wait)
+
+    def acquire(self):
+        start = time.perf_counter()
+        self._semaphore.acquire()
+        if self.requests_per_second:
+            self._take_token()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.calls += 1
+            self.wait_seconds += waited
+
+    def release(self):
+        self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def report(self):
+        logger.info(f"{self.name} budget: {self.calls} calls, waited {self.wait_seconds:.1f}s in total")
+        return {"calls": self.calls, "wait_seconds": self.wait_seconds}
@@ -8,18 +8,26 @@
 #    - 专用分割器 - 自适应选择函数？
 # 3. 分块的大小和重叠度如何影响模型的性能和准确性？ 
 #    - https://zilliz.com.cn/learn/langchain-chunking-milvus
+#    - sweep.py: 网格搜索 chunk_size / chunk_overlap / 算子, 用 qrels 评估
 # 4. 如何处理分块后的数据，以确保信息的完整性和一致性？
 # 5. 分块策略是否需要根据数据的特性进行动态调整？
 # 6. 如何评估分块策略的效果，以便进行优化和改进？
+#    - evaluation.py: nDCG@10 / recall@k / MRR
 # =================
 # !ATTENTION:
 # 1. Tokenize中文、日文可能会产生两个token，分块不当会造成歧义
 # 2. Unicode的中文编码
 # 3. 传入**kwargs, 注意调用方式
 # =================
-from typing import Union, List
+from typing import Union, List, Optional, Iterable, Tuple
+from collections import deque
+import bisect
+import os
+from concurrent.futures import ProcessPoolExecutor
 from langchain_core.documents import Document
 import logging
+import threading
+import tracing
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +38,10 @@ def register_operator(name:str):
         if name in __OPERATOR__:
             logger.error(f"Operator {name} is already registered.")
             raise ValueError(f"Operator {name} is already registered.")
+        # 计时: 只包装算子自己定义的方法, 继承的 execute_batch 内部调用 execute, 避免重复计时
+        for method in ("execute", "execute_batch"):
+            if method in cls.__dict__:
+                setattr(cls, method, tracing.traced(f"chunk_{method}", operator=name)(cls.__dict__[method]))
         __OPERATOR__[name] = cls
         return cls
     return wrapper
@@ -40,6 +52,36 @@ def get_operator(name:str):
         raise ValueError(f"Operator {name} is not registered.")
     return __OPERATOR__[name]
 
+# ================
+# 进程内共享的tokenizer
+# ================
+DEFAULT_TOKENIZER_MODEL = "Qwen/Qwen3-30B-A3B"
+__TOKENIZER__ = {}
+_TOKENIZER_LOCK = threading.Lock()
+
+def get_tokenizer(model: str = DEFAULT_TOKENIZER_MODEL, tokenizer_file: Optional[str] = None):
+    """
+    每个进程对同一个模型只加载一次tokenizer
+    :param model: Hugging Face 模型名称或本地目录
+    :param tokenizer_file: 本地 tokenizer.json 路径, 指定时不访问网络
+    """
+    key = tokenizer_file or model
+    tokenizer = __TOKENIZER__.get(key)
+    if tokenizer is None:
+        with _TOKENIZER_LOCK:
+            tokenizer = __TOKENIZER__.get(key)
+            if tokenizer is None:
+                # 使用Hugging Face的transformers库
+                if tokenizer_file:
+                    from transformers import PreTrainedTokenizerFast
+                    tokenizer = PreTrainedTokenizerFast(tokenizer_file=tokenizer_file)
+                else:
+                    from transformers import AutoTokenizer
+                    tokenizer = AutoTokenizer.from_pretrained(model)
+                __TOKENIZER__[key] = tokenizer
+                logger.info(f"Tokenizer {key} loaded.")
+    return tokenizer
+
 # 抽象类需要实现什么功能？
 class BaseOperator:
     def __init__(self, **kwargs):
@@ -47,13 +89,110 @@ class BaseOperator:
         # 可能需要初始化一些参数或配置
     def execute(self, *args, **kwargs):
         raise NotImplementedError("Subclasses should implement this method.")
+    def execute_batch(self, texts: List[str]) -> List[list]:
+        """
+        批量分块, 子类可重写以批量处理
+        """
+        return [self.execute(text) for text in texts]
     # TODO: model选择
-    def _tokenize_text(self, text: str, model="Qwen/Qwen3-30B-A3B"):
+    def _tokenize_text(self, text: str, model=DEFAULT_TOKENIZER_MODEL):
         """使用指定的模型对文本进行分词"""
-        # 使用Hugging Face的transformers库
-        from transformers import AutoTokenizer
-        tokenizer = AutoTokenizer.from_pretrained(model)
-        return tokenizer.tokenize(text)
+        return get_tokenizer(model).tokenize(text)
+
+    def _split_by_token_offsets(self, texts: List[str], chunk_size: int, chunk_overlap: int,
+                                model=DEFAULT_TOKENIZER_MODEL, tokenizer_file=None) -> List[List[str]]:
+        """
+        按token数分块: 每篇文档只分词一次, 根据 offset mapping 截取原文
+        分块边界落在token边界上, 不会把一个中文字符拆成两半
+        :param texts: 文档列表, 批量分词
+        :param chunk_size: 每块的token数
+        :param chunk_overlap: 相邻块重叠的token数
+        :return: 每篇文档的分块列表
+        """
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size}).")
+        tokenizer = get_tokenizer(model, tokenizer_file)
+        encodings = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+        step = chunk_size - chunk_overlap
+        results = []
+        for text, offsets in zip(texts, encodings["offset_mapping"]):
+            chunks = []
+            for start in range(0, len(offsets), step):
+                window = offsets[start:start + chunk_size]
+                chunk = text[window[0][0]:window[-1][1]]
+                if chunk and not chunk.isspace():
+                    chunks.append(chunk)
+                if start + chunk_size >= len(offsets):
+                    break
+            results.append(chunks)
+        return results
+
+    def _split_structured_by_token_offsets(self, texts: List[str], chunk_size: int, chunk_overlap: int,
+                                           separators: List[str], model=DEFAULT_TOKENIZER_MODEL,
+                                           tokenizer_file=None) -> List[List[str]]:
+        """
+        与 RecursiveCharacterTextSplitter 相同的递归分隔符策略, 但token数由每篇文档一次分词的 offset 计算
+        区间 [a, b) 的token数 = 起始位置落在区间内的token数, 二分查找得到, 不再对候选片段重复分词
+        没有可用的分隔符时退回到按token窗口截取
+        :param separators: 按优先级排列的分隔符, 如 ["\n\n", "\n", " ", ""]
+        :return: 每篇文档的分块列表
+        """
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size}).")
+        tokenizer = get_tokenizer(model, tokenizer_file)
+        encodings = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+        results = []
+        for text, offsets in zip(texts, encodings["offset_mapping"]):
+            starts = [start for start, _ in offsets]
+
+            def count(a: int, b: int) -> int:
+                return bisect.bisect_left(starts, b) - bisect.bisect_left(starts, a)
+
+            def windows(a: int, b: int) -> List[Tuple[int, int]]:
+                first, last = bisect.bisect_left(starts, a), bisect.bisect_left(starts, b)
+                spans = []
+                for i in range(first, last, chunk_size):
+                    j = min(i + chunk_size, last)
+                    spans.append((offsets[i][0], offsets[j - 1][1] if j < last else b))
+                return spans
+
+            def pieces(a: int, b: int, seps: List[str]) -> List[Tuple[int, int]]:
+                """
+                用第一个出现在区间内的分隔符切分, 分隔符留在下一段的开头 (与 langchain 的 keep_separator 一致)
+                超过预算的片段用后续分隔符递归切分
+                """
+                for k, sep in enumerate(seps):
+                    if sep == "" or text.find(sep, a, b) < 0:
+                        continue
+                    cuts, pos = [a], text.find(sep, a + 1, b)
+                    while pos >= 0:
+                        cuts.append(pos)
+                        pos = text.find(sep, pos + len(sep), b)
+                    cuts.append(b)
+                    out = []
+                    for x, y in zip(cuts, cuts[1:]):
+                        if y <= x:
+                            continue
+                        if count(x, y) > chunk_size:
+                            out.extend(pieces(x, y, seps[k + 1:]))
+                        else:
+                            out.append((x, y))
+                    return out
+                return windows(a, b)
+
+            chunks, current = [], []
+            for a, b in pieces(0, len(text), separators):
+                if current and count(current[0][0], b) > chunk_size:
+                    chunks.append((current[0][0], current[-1][1]))
+                    # 保留末尾不超过 chunk_overlap 个token的片段作为重叠
+                    while current and (count(current[0][0], current[-1][1]) > chunk_overlap
+                                       or count(current[0][0], b) > chunk_size):
+                        current.pop(0)
+                current.append((a, b))
+            if current:
+                chunks.append((current[0][0], current[-1][1]))
+            results.append([chunk for chunk in (text[a:b].strip() for a, b in chunks) if chunk])
+        return results
 
 # ================
 # LangChain提供的分块策略
@@ -61,35 +200,71 @@ class BaseOperator:
 from langchain.text_splitter import CharacterTextSplitter
 @register_operator("langchain-length-based")
 class langchain_length_based_splitter(BaseOperator):
-    def __init__(self, separator="", chunk_size=512, chunk_overlap=51, is_tokenized=False, **kwargs):
+    """
+    is_tokenized=True 时 chunk_size/chunk_overlap 的单位为token, 按token边界截取原文
+    """
+    def __init__(self, separator="", chunk_size=512, chunk_overlap=51, is_tokenized=False,
+                 model=DEFAULT_TOKENIZER_MODEL, tokenizer_file=None, **kwargs):
         self.splitter = CharacterTextSplitter(
             separator=separator,
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
             **kwargs,
         )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
         self.is_tokenized = is_tokenized
+        self.model = model
+        self.tokenizer_file = tokenizer_file
     def execute(self, text: str):
         # !!!必须确保text是字符串类型、编码方式是UTF-8
         if self.is_tokenized:
-            text = super()._tokenize_text(text)
-            print(text)
+            return self.execute_batch([text])[0]
         return self.splitter.split_text(text)    
+    def execute_batch(self, texts: List[str]):
+        if self.is_tokenized:
+            return self._split_by_token_offsets(
+                texts, self.chunk_size, self.chunk_overlap, self.model, self.tokenizer_file)
+        return [self.splitter.split_text(text) for text in texts]
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 @register_operator("langchain-structure-based")
 class langchain_structure_based_splitter(BaseOperator):
-    def __init__(self, chunk_size=512, chunk_overlap=51, is_tokenized=False, **kwargs):
-        self.splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            **kwargs,
-        )
+    """
+    is_tokenized=True 时 chunk_size/chunk_overlap 的单位为token
+    每篇文档只分词一次, 递归分隔符切分时按 offset mapping 计算片段的token数
+    """
+    DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+    def __init__(self, chunk_size=512, chunk_overlap=51, is_tokenized=False,
+                 model=DEFAULT_TOKENIZER_MODEL, tokenizer_file=None, separators=None, **kwargs):
         self.is_tokenized = is_tokenized
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.model = model
+        self.tokenizer_file = tokenizer_file
+        self.separators = separators or self.DEFAULT_SEPARATORS
+        if is_tokenized:
+            # 提前加载共享tokenizer, 同时检查参数
+            get_tokenizer(model, tokenizer_file)
+            if chunk_overlap >= chunk_size:
+                raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size}).")
+        else:
+            self.splitter = RecursiveCharacterTextSplitter(
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                separators=self.separators,
+                **kwargs,
+            )
     def execute(self, text: str):
         if self.is_tokenized:
-            text = super()._tokenize_text(text)
+            return self.execute_batch([text])[0]
         return self.splitter.split_text(text)
+    def execute_batch(self, texts: List[str]):
+        if self.is_tokenized:
+            return self._split_structured_by_token_offsets(
+                texts, self.chunk_size, self.chunk_overlap, self.separators, self.model, self.tokenizer_file)
+        return [self.splitter.split_text(text) for text in texts]
 
 from langchain.text_splitter import MarkdownHeaderTextSplitter
 @register_operator("langchain-markdown")
@@ -131,6 +306,17 @@ class MarkdownSplitter(BaseOperator):
         "#####": "Header 5",
         "######": "Header 6",
     }
+    # ==== 预编译的规则, 按优先级排列: 标题 > 行间公式 > 代码块 > 分割线 ====
+    # ```math 必须在 ``` 之前
+    LINE_PATTERN = re.compile(
+        r"^(?:(?P<depth>#{1,6}) (?P<header>.*)"
+        r"|(?P<math>\$\$|```math)"
+        r"|(?P<code>```|~~~)"
+        r"|(?P<horz>(?:\*\*\*+|---+|___+)\n))")
+    MATH_TAIL_PATTERN = re.compile(r"^(?:\$\$|```)")
+    CODE_TAIL_PATTERN = re.compile(r"^(?:```|~~~)")
+    # 不以这些字符开头的行不可能匹配任何规则, 直接跳过正则
+    SPECIAL_FIRST_CHARS = frozenset("#$`~*-_")
 
     def __init__(self, 
                  headers_to_split_on: Union[dict[str, str], None] = None,
@@ -144,58 +330,63 @@ class MarkdownSplitter(BaseOperator):
         self.strip_headers = strip_headers
         self.kwargs = kwargs
         self.chunks : list[Document] = []  # 存储分块后的文本
-        self.current_chunk = Document(page_content="")  # 当前分块内容
         self.current_header_stack: list[tuple[int, str]] = []  # 当前标题栈
         
     def execute(self, text: str) -> list[Document]:
         """
         执行分块操作
+        单次遍历: 游标指向当前行, 分块内容以行列表收集, 完成时只 join 一次
         :param text: 输入的文本
         :return: 分块后的文本列表
         """
         self.chunks = []  # 清空之前的分块结果
-        self.current_chunk = Document(page_content="")  # 重置当前分块内容
         self.current_header_stack = []  # 重置当前标题栈
 
-        raw_lines = text.splitlines(keepends=True)
-        while raw_lines:
-            raw_line = raw_lines.pop(0)
+        lines = text.splitlines(keepends=True)
+        n_lines = len(lines)
+        special = self.SPECIAL_FIRST_CHARS
+        match_line = self.LINE_PATTERN.match
+        current: list[str] = []  # 当前分块的行
+        cursor = 0
+        while cursor < n_lines:
+            raw_line = lines[cursor]
+            cursor += 1
+            if raw_line[0] not in special:
+                current.append(raw_line)
+                continue
             # ==== 优先级  =====
             # 这些match不添加在chunk中,header可能除外
-            header_match = self._split_by_headers(raw_line)
-            math_match = self._split_by_math(raw_line)
-            code_match = self._split_by_code(raw_line)
-            horz_match = self._split_by_horz(raw_line)
-  
-            if header_match:
-                self._complete_current_chunk()
-                depth = len(header_match.group(1))
-                header_text = header_match.group(2)
+            match = match_line(raw_line)
+            kind = match.lastgroup if match else None
+
+            if kind == "header" and match.group("depth") in self.headers_to_split_on:
+                self._complete_chunk(current)
+                current = []
+                header_text = match.group("header")
                 if not self.strip_headers:
                     # 如果不需要去除标题，则将标题添加到当前分块
-                    self.current_chunk.page_content += f"{header_text}\n"
+                    current.append(f"{header_text}\n")
                 
-                self._resolve_header_stack(depth, header_text)
-            elif math_match:
+                self._resolve_header_stack(len(match.group("depth")), header_text)
+            elif kind == "math":
                 # 行间公式单独分块
-                self._complete_current_chunk()
-                self.current_chunk.page_content = self._aggregate_math_line(
-                    self.current_chunk.page_content, raw_lines)
-                self.current_chunk.metadata = {"type": "math"}
-                self._complete_current_chunk()
-            elif code_match:
+                self._complete_chunk(current)
+                current = []
+                cursor, block = self._aggregate_block(lines, cursor, self.MATH_TAIL_PATTERN, "math")
+                self._complete_chunk(block, {"type": "math"})
+            elif kind == "code":
                 # 行间代码块单独分块
-                self._complete_current_chunk()
-                self.current_chunk.page_content = self._aggregate_code_line(
-                    self.current_chunk.page_content, raw_lines)
-                self.current_chunk.metadata = {"type": "code"}
-                self._complete_current_chunk()
-            elif horz_match:
+                self._complete_chunk(current)
+                current = []
+                cursor, block = self._aggregate_block(lines, cursor, self.CODE_TAIL_PATTERN, "code")
+                self._complete_chunk(block, {"type": "code"})
+            elif kind == "horz":
                 # 分割线直接分块吗？
-                self._complete_current_chunk()
+                self._complete_chunk(current)
+                current = []
             else:
-                self.current_chunk.page_content += raw_line
-        self._complete_current_chunk()
+                current.append(raw_line)
+        self._complete_chunk(current)
         return self.chunks
     
     def _resolve_header_stack(self, depth: int, header_text: str):
@@ -211,66 +402,52 @@ class MarkdownSplitter(BaseOperator):
         # 添加新的标题到当前标题栈
         self.current_header_stack.append((depth, header_text))
     
-    def _complete_current_chunk(self):
+    def _complete_chunk(self, lines: List[str], metadata: Union[dict, None] = None):
         """
         完成当前分块，将其添加到分块列表中
         添加metadata信息
+        :param lines: 分块包含的行
+        :param metadata: 分块的初始metadata
         """
-        chunk = self.current_chunk
-        if chunk.page_content and not chunk.page_content.isspace():
+        page_content = "".join(lines)
+        if page_content and not page_content.isspace():
+            metadata = dict(metadata) if metadata else {}
             for depth, header in self.current_header_stack:
                 key = self.headers_to_split_on.get("#" * depth)
                 if key:
-                    chunk.metadata[key] = header
-            self.chunks.append(chunk)
-        # reset current chunk
-        # current_chunk 只涉及page_content
-        self.current_chunk = Document(page_content="")
-
-    def _aggregate_code_line(self, current_chunk: str, raw_lines: List[str]):
-        chunk = current_chunk 
-        while raw_lines:
-            raw_line = raw_lines.pop(0)
-            if self._split_by_code(raw_line):
-                # 行间代码块
-                return chunk
-            chunk += raw_line
-
-        logger.warning("No match code found in the remaining lines.")
-        return ""
+                    metadata[key] = header
+            self.chunks.append(Document(page_content=page_content, metadata=metadata))
 
-    def _aggregate_math_line(self, current_chunk: str, raw_lines: List[str]):
-        chunk = current_chunk 
-        while raw_lines:
-            raw_line = raw_lines.pop(0)
-            if self._split_by_math(raw_line, is_tail=True):
-                # 行间公式
-                return chunk
-            chunk += raw_line
+    def _aggregate_block(self, lines: List[str], cursor: int, tail_pattern: re.Pattern, kind: str):
+        """
+        从 cursor 开始收集行, 直到遇到结束标记
+        :return: (结束标记之后的游标, 块内的行); 没有结束标记时消耗剩余所有行并返回空块
+        """
+        match_tail = tail_pattern.match
+        for end in range(cursor, len(lines)):
+            if match_tail(lines[end]):
+                return end + 1, lines[cursor:end]
+        logger.warning(f"No match {kind} found in the remaining lines.")
+        return len(lines), []
 
-        logger.warning("No match math found in the remaining lines.")
-        return ""
-    
     def _split_by_headers(self, line: str):
-        match = re.match(r"^(#{1,6}) (.*)", line)
-        if match and match.group(1) in self.headers_to_split_on:
+        match = self.LINE_PATTERN.match(line)
+        if match and match.lastgroup == "header" and match.group("depth") in self.headers_to_split_on:
             return match 
         return None
 
     def _split_by_code(self, line: str):
-        match = [re.match(rule, line) for rule in [r"^```(.*)", r"^~~~(.*)"]]
-        return next((match for match in match if match), None)
+        return self.CODE_TAIL_PATTERN.match(line)
 
     def _split_by_horz(self, line: str):
-        match = [re.match(rule, line) for rule in [r"^\*\*\*+\n", r"^---+\n", r"^___+\n"]]
-        return next((match for match in match if match), None)
+        match = self.LINE_PATTERN.match(line)
+        return match if match and match.lastgroup == "horz" else None
 
     def _split_by_math(self, line: str, is_tail: bool = False):
         if is_tail:
-            match = [re.match(rule, line) for rule in [r"^\$\$(.*)", r"^```(.*)"]]
-        else:
-            match = [re.match(rule, line) for rule in [r"^\$\$(.*)", r"^```math(.*)"]]
-        return next((match for match in match if match), None)
+            return self.MATH_TAIL_PATTERN.match(line)
+        match = self.LINE_PATTERN.match(line)
+        return match if match and match.lastgroup == "math" else None
 
     def _split_by_inline_content(self, text: str):
         """
@@ -318,6 +495,332 @@ class MarkdownSplitter(BaseOperator):
         matched = "www.inline-code.com"  # TODO: 处理行内代码块
         return matched
 
+# ================
+# 表格分块
+# ================
+from html.parser import HTMLParser
+
+class _HTMLTableParser(HTMLParser):
+    """
+    将 <table> 解析为单元格文本的二维列表, colspan 展开为重复单元格
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows: List[List[str]] = []
+        self.header_rows = 0
+        self._in_thead = False
+        self._row: Optional[List[str]] = None
+        self._cell: Optional[List[str]] = None
+        self._colspan = 1
+        self._row_is_header = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "thead":
+            self._in_thead = True
+        elif tag == "tr":
+            self._row, self._row_is_header = [], True
+        elif tag in ("td", "th") and self._row is not None:
+            self._cell = []
+            self._row_is_header &= tag == "th"
+            colspan = dict(attrs).get("colspan") or "1"
+            self._colspan = int(colspan) if colspan.isdigit() else 1
+        elif tag == "br" and self._cell is not None:
+            self._cell.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag == "thead":
+            self._in_thead = False
+        elif tag in ("td", "th") and self._cell is not None:
+            self._row.extend([" ".join("".join(self._cell).split())] * self._colspan)
+            self._cell = None
+        elif tag == "tr" and self._row is not None:
+            if any(self._row):
+                # 表头: <thead> 中的行, 或表格开头全部由 <th> 组成的行
+                if (self._in_thead or self._row_is_header) and len(self.rows) == self.header_rows:
+                    self.header_rows += 1
+                self.rows.append(self._row)
+            self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+@register_operator("table-splitter")
+class TableSplitter(BaseOperator):
+    """
+    表格感知的分块
+    ===== 逻辑 =====
+    1. 识别 markdown 表格 (表头行 + |---| 分隔行) 与 HTML <table>
+    2. 表格压缩为每行一条 "单元格 | 单元格", 去掉对齐线、多余空白和空行
+    3. 按预算将连续的行打包为行组, 每个行组重复表头 (和表格前的标题行), 单独成块
+    4. 表格以外的文本交给 text_operator 分块
+    chunk_size 的单位: is_tokenized=True 时为token, 否则为字符
+    """
+    # 分隔行至少包含一个 "|", 避免把 "---" 水平线或 front matter 分隔符当作表格
+    MD_SEPARATOR_PATTERN = re.compile(r"^(?=[^|\n]*\|)\s*\|?\s*:?-{3,}:?\s*(?:\|\s*:?-{3,}:?\s*)*\|?\s*$")
+    MD_ROW_PATTERN = re.compile(r"(?<!\\)\|")
+    HTML_TABLE_PATTERN = re.compile(r"<table\b.*?</table\s*>", re.IGNORECASE | re.DOTALL)
+
+    def __init__(self, chunk_size=512, is_tokenized=False, model=DEFAULT_TOKENIZER_MODEL, tokenizer_file=None,
+                 text_operator="langchain-structure-based", text_kwargs=None, caption_max_length=200,
+                 **kwargs):
+        """
+        :param chunk_size: 每个表格分块的预算
+        :param text_operator: 表格以外文本使用的分块算子, 默认与 chunk_size 一致
+        :param caption_max_length: 表格前一行不超过该长度时作为标题重复到每个行组
+        """
+        self.chunk_size = chunk_size
+        self.is_tokenized = is_tokenized
+        self.model = model
+        self.tokenizer_file = tokenizer_file
+        self.caption_max_length = caption_max_length
+        if text_kwargs is None:
+            text_kwargs = {"chunk_size": chunk_size, "is_tokenized": is_tokenized,
+                           "model": model, "tokenizer_file": tokenizer_file}
+        self.text_operator = get_operator(text_operator)(**text_kwargs) if text_operator else None
+        self.kwargs = kwargs
+
+    def execute(self, text: str) -> List[Document]:
+        chunks: List[Document] = []
+        table_index = 0
+        for kind, segment in self._segments(text):
+            if kind == "text":
+                chunks.extend(self._split_text(segment))
+            else:
+                caption, header, rows = segment
+                chunks.extend(self._split_table(caption, header, rows, table_index))
+                table_index += 1
+        return chunks
+
+    # ===== 解析 =====
+    def _segments(self, text: str):
+        """
+        按出现顺序切分为 ("text", str) 与 ("table", (caption, header, rows))
+        """
+        cursor = 0
+        for match in self.HTML_TABLE_PATTERN.finditer(text):
+            yield from self._markdown_segments(text[cursor:match.start()])
+            parser = _HTMLTableParser()
+            parser.feed(match.group(0))
+            header_rows = max(parser.header_rows, 1)
+            header = [" / ".join(cell for cell in dict.fromkeys(column) if cell)
+                      for column in zip(*parser.rows[:header_rows])] if parser.rows else []
+            rows = parser.rows[header_rows:]
+            yield "table", (self._caption(text[cursor:match.start()]), header, rows)
+            cursor = match.end()
+        yield from self._markdown_segments(text[cursor:])
+
+    def _markdown_segments(self, text: str):
+        lines = text.splitlines(keepends=True)
+        is_separator = self.MD_SEPARATOR_PATTERN.match
+        buffer: List[str] = []
+        cursor = 0
+        while cursor < len(lines):
+            line = lines[cursor]
+            # 表头行需要包含未转义的 "|"
+            if (cursor + 1 < len(lines) and self.MD_ROW_PATTERN.search(line)
+                    and is_separator(lines[cursor + 1])):
+                end = cursor + 2
+                while end < len(lines) and "|" in lines[end] and lines[end].strip():
+                    end += 1
+                preceding = "".join(buffer)
+                if preceding.strip():
+                    yield "text", preceding
+                buffer = []
+                rows = [self._md_cells(row) for row in lines[cursor + 2:end]]
+                yield "table", (self._caption(preceding), self._md_cells(line), rows)
+                cursor = end
+                continue
+            buffer.append(line)
+            cursor += 1
+        remaining = "".join(buffer)
+        if remaining.strip():
+            yield "text", remaining
+
+    @staticmethod
+    def _md_cells(line: str) -> List[str]:
+        line = line.strip()
+        if line.startswith("|"):
+            line = line[1:]
+        if line.endswith("|") and not line.endswith("\\|"):
+            line = line[:-1]
+        return [" ".join(cell.split()) for cell in re.split(r"(?<!\\)\|", line)]
+
+    def _caption(self, preceding: str) -> str:
+        for line in reversed(preceding.splitlines()):
+            line = line.strip()
+            if line:
+                return line if len(line) <= self.caption_max_length else ""
+        return ""
+
+    # ===== 分块 =====
+    def _length(self, texts: List[str]) -> List[int]:
+        if not texts:
+            return []
+        if self.is_tokenized:
+            tokenizer = get_tokenizer(self.model, self.tokenizer_file)
+            return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+        return [len(text) for text in texts]
+
+    def _split_text(self, text: str) -> List[Document]:
+        if self.text_operator is None:
+            return [Document(page_content=text.strip(), metadata={"type": "text"})]
+        chunks = []
+        for chunk in self.text_operator.execute(text):
+            if not isinstance(chunk, Document):
+                chunk = Document(page_content=chunk, metadata={})
+            chunk.metadata.setdefault("type", "text")
+            chunks.append(chunk)
+        return chunks
+
+    def _split_table(self, caption: str, header: List[str], rows: List[List[str]], table_index: int) -> List[Document]:
+        rows = [row for row in rows if any(row)]
+        if not rows and not any(header):
+            return []
+        head_lines = ([caption] if caption else []) + ([" | ".join(header)] if any(header) else [])
+        head = "\n".join(head_lines)
+        lines = [" | ".join(row) for row in rows]
+        head_length, *row_lengths = self._length([head] + lines)
+        # 每行额外计入一个换行
+        budget = self.chunk_size - head_length - 1
+
+        chunks = []
+        start, used = 0, 0
+        def emit(end):
+            body = "\n".join(lines[start:end])
+            chunks.append(Document(
+                page_content=f"{head}\n{body}" if head else body,
+                metadata={"type": "table", "table_index": table_index, "rows": [start, end]}))
+        for i, length in enumerate(row_lengths):
+            # 单行超过预算时单独成块
+            if i > start and used + length + 1 > budget:
+                emit(i)
+                start, used = i, 0
+            used += length + 1
+        if lines:
+            emit(len(lines))
+        else:
+            chunks.append(Document(page_content=head, metadata={"type": "table", "table_index": table_index,
+                                                                "rows": [0, 0]}))
+        return chunks
+
+# ================
+# 语料批量分块
+# ================
+def to_chunk_records(doc: dict, chunks: list) -> List[dict]:
+    """
+    将算子的输出统一为分块记录
+    :param doc: 语料记录 {"_id", "title", "text"}
+    :param chunks: 算子输出, str 或 Document
+    :return: [{"id": "<doc_id>-<chunk_index>", "text": ..., "metadata": {...}}, ...]
+    """
+    records = []
+    for i, chunk in enumerate(chunks):
+        if isinstance(chunk, Document):
+            text, metadata = chunk.page_content, dict(chunk.metadata)
+        else:
+            text, metadata = chunk, {}
+        if not text or text.isspace():
+            continue
+        metadata.update({"doc_id": doc["_id"], "chunk_index": i,
+                         "title": doc.get("title", ""), "text": text})
+        records.append({"id": f"{doc['_id']}-{i}", "text": text, "metadata": metadata})
+    return records
+
+_WORKER_OPERATOR = None
+
+def _init_chunk_worker(operator_name: str, operator_kwargs: dict, trace: bool = False):
+    """
+    每个工作进程只创建一次算子 (以及它需要的tokenizer)
+    :param trace: 主进程是否开启了 tracing, spawn 启动的进程不会继承该状态
+    """
+    global _WORKER_OPERATOR
+    tracing.enable(trace)
+    # fork 启动时会复制主进程已有的记录, 清空后只带回本进程新增的部分
+    tracing.reset()
+    _WORKER_OPERATOR = get_operator(operator_name)(**operator_kwargs)
+
+def _chunk_documents(docs: List[dict]):
+    """
+    :return: (每篇文档的分块记录, 本任务的 tracing 快照), 快照由主进程合并
+    """
+    results = _WORKER_OPERATOR.execute_batch([doc["text"] for doc in docs])
+    return [to_chunk_records(doc, chunks) for doc, chunks in zip(docs, results)], tracing.drain()
+
+def make_chunk_pool(operator_name: str,
+                    operator_kwargs: Optional[dict] = None,
+                    max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    创建分块进程池, 可以传给多次 chunk_corpus 调用共享 (如并发处理的多个子集)
+    """
+    return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count() or 1,
+                               initializer=_init_chunk_worker,
+                               initargs=(operator_name, operator_kwargs or {}, tracing.is_enabled()))
+
+def chunk_corpus(docs: Iterable[dict],
+                 operator_name: str,
+                 operator_kwargs: Optional[dict] = None,
+                 max_workers: Optional[int] = None,
+                 docs_per_task: int = 16,
+                 max_pending: Optional[int] = None,
+                 executor: Optional[ProcessPoolExecutor] = None):
+    """
+    使用进程池并行分块, 按文档顺序流式返回
+    :param docs: 语料记录的迭代器, 如 utils.iter_jsonl("corpus_prep.jsonl")
+    :param operator_name: __OPERATOR__ 中注册的算子名称
+    :param operator_kwargs: 算子参数
+    :param max_workers: 进程数, None 为CPU核数, 1 表示在当前进程中执行
+    :param docs_per_task: 每个任务包含的文档数, 摊薄进程间通信开销
+    :param max_pending: 最多在途的任务数, 控制内存, 默认 max_workers * 4
+    :param executor: make_chunk_pool 创建的共享进程池 (算子与参数须一致), 指定时不再创建新的进程池
+    :return: 生成器, 每条为 to_chunk_records 的记录
+    """
+    operator_kwargs = operator_kwargs or {}
+    get_operator(operator_name)  # 提前检查算子是否注册
+
+    def tasks():
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= docs_per_task:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    if max_workers == 1 and executor is None:
+        operator = get_operator(operator_name)(**operator_kwargs)
+        for task in tasks():
+            results = operator.execute_batch([doc["text"] for doc in task])
+            for doc, chunks in zip(task, results):
+                yield from to_chunk_records(doc, chunks)
+        return
+
+    def collect(future):
+        documents, snapshot = future.result()
+        tracing.merge(snapshot)
+        return documents
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or max_workers * 4
+    own_executor = executor is None
+    if own_executor:
+        executor = make_chunk_pool(operator_name, operator_kwargs, max_workers)
+    try:
+        pending = deque()
+        for task in tasks():
+            pending.append(executor.submit(_chunk_documents, task))
+            # 按提交顺序取回结果, 保证输出顺序与语料一致
+            while len(pending) >= max_pending:
+                for records in collect(pending.popleft()):
+                    yield from records
+        while pending:
+            for records in collect(pending.popleft()):
+                yield from records
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
 if __name__ == "__main__":
     # 测试 langchain_markdown_splitter
     splitter = get_operator("markdown-splitter")()
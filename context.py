@@ -0,0 +1,152 @@
+import logging
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional, Sequence, Union
+from embedding import _approx_token_count
+from prompt_registry import get_registry
+
+logger = logging.getLogger(__name__)
+"""
+    生成阶段的上下文组装
+    1. 合并同一文档中相邻的分块, 去掉分块之间的重叠 (chunk_overlap)
+    2. 去掉近似重复的段落, 保留分数较高的一个
+    3. 按 rerank 分数贪心填充 token 预算
+    4. 使用 prompt.json 中 generate 分组的模版拼接提示词, 静态模版在前
+"""
+
+class Passage(NamedTuple):
+    doc_id: str
+    chunk_indices: List[int]
+    title: str
+    text: str
+    score: float
+
+class PackedContext(NamedTuple):
+    prompt: str
+    passages: List[Passage]
+    tokens: int
+    dropped: int
+
+def _merge_text(left: str, right: str, max_overlap: int = 2048) -> str:
+    """
+    拼接相邻分块: left 的后缀与 right 的前缀重叠时只保留一份
+    """
+    anchor = right[:16]
+    if not anchor:
+        return left
+    pos = left.find(anchor, max(0, len(left) - max_overlap))
+    while pos >= 0:
+        if right.startswith(left[pos:]):
+            return left[:pos] + right
+        pos = left.find(anchor, pos + 1)
+    return f"{left}\n{right}"
+
+def merge_passages(hits: Sequence[dict], scores: Optional[Sequence[float]] = None) -> List[Passage]:
+    """
+    合并同一文档中编号相邻的分块, 段落分数取分块分数的最大值
+    表格行组各自带有表头, 不参与合并
+    :param hits: 检索结果 [{"id", "score", "metadata": {"doc_id", "chunk_index", "title", "text", ...}}, ...]
+    :param scores: rerank 分数, 与 hits 一一对应, None 时使用 hit["score"]
+    :return: 按分数降序的段落
+    """
+    if scores is None:
+        scores = [hit["score"] for hit in hits]
+    by_doc = {}
+    seen = set()
+    for hit, score in zip(hits, scores):
+        if hit["id"] in seen:
+            continue
+        seen.add(hit["id"])
+        metadata = hit.get("metadata") or {}
+        by_doc.setdefault(metadata.get("doc_id", hit["id"]), []).append((metadata, float(score)))
+
+    passages = []
+    for doc_id, chunks in by_doc.items():
+        chunks.sort(key=lambda item: item[0].get("chunk_index", 0))
+        group = None
+        for metadata, score in chunks:
+            index = metadata.get("chunk_index", 0)
+            mergeable = (group is not None and index == group["indices"][-1] + 1
+                         and metadata.get("type") != "table" and not group["table"])
+            if mergeable:
+                group["text"] = _merge_text(group["text"], metadata.get("text", ""))
+                group["indices"].append(index)
+                group["score"] = max(group["score"], score)
+                continue
+            if group is not None:
+                passages.append(Passage(doc_id, group["indices"], group["title"], group["text"], group["score"]))
+            group = {"indices": [index], "title": metadata.get("title", ""), "text": metadata.get("text", ""),
+                     "score": score, "table": metadata.get("type") == "table"}
+        if group is not None:
+            passages.append(Passage(doc_id, group["indices"], group["title"], group["text"], group["score"]))
+    passages.sort(key=lambda passage: passage.score, reverse=True)
+    return passages
+
+def _shingles(text: str, size: int) -> set:
+    words = text.lower().split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def drop_near_duplicates(passages: Sequence[Passage], threshold: float = 0.8, shingle_size: int = 5) -> List[Passage]:
+    """
+    按顺序保留段落, 与已保留段落的词 shingle 重合度 (相对较短的一方) 不低于 threshold 时丢弃
+    :param passages: 按分数降序, 分数高的优先保留
+    """
+    kept, kept_shingles = [], []
+    for passage in passages:
+        shingles = _shingles(passage.text, shingle_size)
+        duplicate = any(len(shingles & other) >= threshold * min(len(shingles), len(other))
+                        for other in kept_shingles)
+        if not duplicate:
+            kept.append(passage)
+            kept_shingles.append(shingles)
+    return kept
+
+def format_passage(i: int, passage: Passage) -> str:
+    title = f" {passage.title}" if passage.title else ""
+    return f"[{i}]{title}\n{passage.text.strip()}"
+
+def render_prompt(template: str, passages: Sequence[Passage], question: str) -> str:
+    """
+    静态模版在前, 文档与查询在后
+    """
+    blocks = "\n\n".join(format_passage(i, passage) for i, passage in enumerate(passages, start=1))
+    return f"{template}\n\n# Documents\n{blocks}\n\n# Question\n{question}\n"
+
+def pack_context(hits: Sequence[dict],
+                 question: str,
+                 subset: str,
+                 max_tokens: int = 3000,
+                 scores: Optional[Sequence[float]] = None,
+                 dedup_threshold: float = 0.8,
+                 token_counter: Callable[[str], int] = _approx_token_count,
+                 prompt_path: Union[str, Path] = Path("./prompt.json")) -> PackedContext:
+    """
+    :param hits: 一个查询的检索结果
+    :param question: 原始查询
+    :param subset: 数据集子集名称, 用于选择 generate 模版
+    :param max_tokens: 整个提示词的 token 预算
+    :param scores: rerank 分数, 与 hits 一一对应
+    :param dedup_threshold: 近似重复的阈值, None 表示不去重
+    :param token_counter: token计数函数
+    """
+    template = get_registry(prompt_path).get_template(("generate",), subset)
+    used = token_counter(render_prompt(template.text, [], question))
+
+    passages = merge_passages(hits, scores)
+    if dedup_threshold is not None:
+        passages = drop_near_duplicates(passages, dedup_threshold)
+
+    selected = []
+    for passage in passages:
+        n_tokens = token_counter(format_passage(len(selected) + 1, passage)) + 1
+        # 放不下时继续尝试较短的段落
+        if used + n_tokens > max_tokens:
+            continue
+        selected.append(passage)
+        used += n_tokens
+
+    dropped = len(passages) - len(selected)
+    if dropped:
+        logger.debug(f"Context budget {max_tokens}: kept {len(selected)} passages, dropped {dropped}.")
+    return PackedContext(render_prompt(template.text, selected, question), selected, used, dropped)
@@ -0,0 +1,140 @@
+import os
+import mmap
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from utils import json_loads, json_dumps
+
+logger = logging.getLogger(__name__)
+"""
+    corpus_prep.jsonl 的字节偏移索引
+    旁路文件 <corpus>.idx 记录 _id -> (offset, length), 每个语料文件只需构建一次
+    CorpusReader 通过 mmap 按 _id 读取单条记录, 生成答案时不需要把整个语料加载到内存
+"""
+
+def _index_path(corpus_path: str) -> str:
+    return f"{corpus_path}.idx"
+
+# 索引格式版本, 旧格式的索引在读取时重新构建
+INDEX_FORMAT = 2
+
+def _source_signature(corpus_path: str) -> dict:
+    stat = os.stat(corpus_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "format": INDEX_FORMAT}
+
+def build_offset_index(corpus_path: str, id_key: str = "_id") -> Dict[str, Tuple[int, int]]:
+    """
+    扫描一遍语料, 写出旁路索引
+    索引格式: 第一行为源文件签名 (JSON), 之后每行一个 JSON 数组 [id, offset, length]
+    id 只支持 str 与 int, 以 JSON 保存, 读取时类型不变, 其中的制表符、换行符也不会破坏索引
+    :return: {_id: (offset, length)}
+    """
+    if not os.path.exists(corpus_path):
+        logger.error(f"File {corpus_path} does not exist.")
+        raise FileNotFoundError(f"File {corpus_path} does not exist.")
+
+    signature = _source_signature(corpus_path)
+    offsets = {}
+    offset = 0
+    with open(corpus_path, "rb") as f:
+        for line in f:
+            length = len(line)
+            stripped = line.strip()
+            if stripped:
+                doc_id = json_loads(stripped)[id_key]
+                if not isinstance(doc_id, (str, int)) or isinstance(doc_id, bool):
+                    logger.error(f"Unsupported id {doc_id!r} in {corpus_path}, expected str or int.")
+                    raise ValueError(f"Unsupported id {doc_id!r} in {corpus_path}, expected str or int.")
+                if doc_id in offsets:
+                    logger.warning(f"Duplicate id {doc_id} in {corpus_path}, keep the last one.")
+                offsets[doc_id] = (offset, len(line.rstrip(b"\r\n")))
+            offset += length
+
+    tmp_path = _index_path(corpus_path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json_dumps(signature) + b"\n")
+        for doc_id, (start, length) in offsets.items():
+            f.write(json_dumps([doc_id, start, length]) + b"\n")
+    os.replace(tmp_path, _index_path(corpus_path))
+    logger.info(f"Offset index built for {corpus_path}: {len(offsets)} records.")
+    return offsets
+
+def load_offset_index(corpus_path: str, id_key: str = "_id") -> Dict[str, Tuple[int, int]]:
+    """
+    读取旁路索引; 索引不存在或语料已修改 (大小/mtime 变化) 时重新构建
+    """
+    index_path = _index_path(corpus_path)
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            signature = json_loads(f.readline())
+            if signature == _source_signature(corpus_path):
+                offsets = {}
+                for line in f:
+                    doc_id, start, length = json_loads(line)
+                    offsets[doc_id] = (start, length)
+                return offsets
+        logger.info(f"Offset index {index_path} is stale, rebuilding.")
+    return build_offset_index(corpus_path, id_key)
+
+class CorpusReader:
+    """
+    按 _id 随机读取语料记录, O(1) 定位, 只解析被请求的记录
+
+    用法:
+        with CorpusReader("data/FinQA/corpus_prep.jsonl") as corpus:
+            doc = corpus.get("d1234")
+    """
+    def __init__(self, corpus_path: str, id_key: str = "_id"):
+        self.corpus_path = corpus_path
+        self._offsets = load_offset_index(corpus_path, id_key)
+        self._file = open(corpus_path, "rb")
+        # 空文件无法 mmap
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(corpus_path) else None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __contains__(self, doc_id: str):
+        return doc_id in self._offsets
+
+    def ids(self) -> Iterable[str]:
+        return self._offsets.keys()
+
+    def get(self, doc_id: str, default=None) -> Optional[dict]:
+        # 与 close() 使用同一把锁, 避免读取过程中 mmap 被关闭
+        with self._lock:
+            if self._file.closed:
+                raise ValueError(f"CorpusReader for {self.corpus_path} is closed.")
+            location = self._offsets.get(doc_id)
+            if location is None:
+                return default
+            start, length = location
+            data = self._mmap[start:start + length]
+        return json_loads(data)
+
+    def get_many(self, doc_ids: List[str]) -> List[Optional[dict]]:
+        """
+        按偏移排序后读取, 对磁盘更友好; 返回顺序与 doc_ids 一致
+        """
+        order = sorted(range(len(doc_ids)),
+                       key=lambda i: self._offsets.get(doc_ids[i], (-1, 0))[0])
+        out: List[Optional[dict]] = [None] * len(doc_ids)
+        for i in order:
+            out[i] = self.get(doc_ids[i])
+        return out
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,11 +1,34 @@
+import time
+import asyncio
 import requests
 import logging
+import threading
+import numpy as np
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import tracing
 """
     英语文本用 zh-embeddings ......
 """
 
 logger = logging.getLogger(__name__)
 
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def _shared_client(url, api_key, model, timeout) -> "EmbeddingClient":
+    """
+    get_embedding 使用的进程内共享客户端, 相同的 (url, api_key, model, timeout) 复用同一个连接池
+    """
+    key = (url, api_key, model, timeout)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = _CLIENTS[key] = EmbeddingClient(url=url, api_key=api_key, model=model, timeout=timeout)
+        return client
+
 def get_embedding(
     text,
     url,
@@ -13,23 +36,295 @@ def get_embedding(
     model="models/bge-large-zh-v1.5",
     timeout=10.0,
     **kwargs) -> dict:
-
-    if api_key or url is None:
+    """
+    单次请求的兼容接口, 通过共享的 EmbeddingClient 发送 (连接复用、失败重试)
+    请求的计时由 EmbeddingClient 记录 (embedding_request, api=client)
+    :param text: 单条文本或文本列表
+    :return: 服务端的响应 {"data": [{"index", "embedding"}], ...}, 失败为 None
+    """
+    if not api_key or url is None:
         logger.error("API key or URL is not provided.")
-
-    headers = {"Accept": "application/json",
-               "Authorization": f"Bearer {api_key}",
-               "Content-Type": "application/json",
-               }
-    data = {"model": model,
-            "encoding_format": "float",
-            "user": "string",
-            "dimensions": 1024,
-            "input": text}
+        return None
     try:
-        response = requests.post(url, json=data, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        return response.json()
+        return _shared_client(url, api_key, model, timeout)._post(text)
     except requests.exceptions.RequestException as e:
         logger.exception("Embedding request failed: %s", e)
         return None
+
+def _approx_token_count(text: str) -> int:
+    """
+    粗略估计token数, 英文约4个字符一个token
+    """
+    return len(text) // 4 + 1
+
+class EmbeddingClient:
+    """
+    批量Embedding客户端
+    - 复用连接池 (keep-alive), 避免每次请求都重新建立TCP连接
+    - 按条数与token预算自动切分批次
+    - 请求失败时指数退避重试
+    - 返回按输入顺序排列的连续 NumPy 数组
+    """
+    def __init__(self,
+                 url: str,
+                 api_key: str,
+                 model: str = "models/bge-large-zh-v1.5",
+                 dimensions: int = 1024,
+                 max_batch_size: int = 64,
+                 max_batch_tokens: int = 8192,
+                 max_retries: int = 3,
+                 backoff: float = 0.5,
+                 timeout: float = 30.0,
+                 pool_size: int = 8,
+                 token_counter: Callable[[str], int] = _approx_token_count,
+                 budget=None):
+        """
+        :param url: embeddings接口地址
+        :param api_key: API key
+        :param model: 模型名称
+        :param dimensions: 向量维度
+        :param max_batch_size: 单次请求的最大文本条数
+        :param max_batch_tokens: 单次请求的最大token数(估计值)
+        :param max_retries: 最大重试次数
+        :param backoff: 首次重试等待秒数, 之后每次翻倍
+        :param timeout: 单次请求超时时间
+        :param pool_size: 连接池大小, 与并发调用的线程数一致即可
+        :param token_counter: token计数函数
+        :param budget: 可选的 budget.RateBudget, 多个子集并发时共享的并发与速率上限
+        """
+        if not api_key or url is None:
+            logger.error("API key or URL is not provided.")
+            raise ValueError("API key or URL is not provided.")
+        self.url = url
+        self.model = model
+        self.dimensions = dimensions
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.token_counter = token_counter
+        self.budget = budget
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/json",
+                                     "Authorization": f"Bearer {api_key}",
+                                     "Content-Type": "application/json",
+                                     })
+
+    def _iter_batches(self, texts: List[str]):
+        """
+        按条数和token预算切分, 返回 (start, end) 区间
+        单条超过token预算的文本独占一个批次, 由服务端截断
+        """
+        start, tokens = 0, 0
+        for i, text in enumerate(texts):
+            n_tokens = self.token_counter(text)
+            if i > start and (i - start >= self.max_batch_size
+                              or tokens + n_tokens > self.max_batch_tokens):
+                yield start, i
+                start, tokens = i, 0
+            tokens += n_tokens
+        if start < len(texts):
+            yield start, len(texts)
+
+    def _post(self, texts: List[str]) -> dict:
+        data = {"model": self.model,
+                "encoding_format": "float",
+                "user": "string",
+                "dimensions": self.dimensions,
+                "input": texts}
+        error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                # 先取得预算再计时, 延迟中不包含排队等待预算的时间
+                with self.budget or nullcontext(), tracing.span("embedding_request", api="client"):
+                    response = self.session.post(self.url, json=data, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                error = e
+            else:
+                # 4xx (除 429 外) 重试无意义, 直接抛出
+                if response.status_code < 500 and response.status_code != 429:
+                    response.raise_for_status()
+                    if tracing.is_enabled():
+                        tracing.count("embedding_texts_total", len(texts))
+                        tracing.count("embedding_bytes_sent_total", len(response.request.body or b""))
+                        tracing.count("embedding_bytes_received_total", len(response.content))
+                    return response.json()
+                error = requests.exceptions.HTTPError(
+                    f"{response.status_code} Server Error for url: {self.url}", response=response)
+            if attempt < self.max_retries:
+                tracing.count("embedding_retries_total")
+                wait = self.backoff * (2 ** attempt)
+                logger.warning(f"Embedding request failed ({error}), retry in {wait:.1f}s")
+                time.sleep(wait)
+        logger.error("Embedding request failed after %d retries: %s", self.max_retries, error)
+        raise error
+
+    def embed(self, texts: Union[str, List[str]]) -> np.ndarray:
+        """
+        :param texts: 单条文本或文本列表
+        :return: shape=(len(texts), dimensions) 的 float32 数组, 与输入顺序一致
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        out = np.empty((len(texts), self.dimensions), dtype=np.float32)
+        for start, end in self._iter_batches(texts):
+            result = self._post(texts[start:end])
+            # 服务端返回的 data 不保证顺序, 按 index 放回
+            for item in result["data"]:
+                out[start + item["index"]] = item["embedding"]
+        return out
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class AsyncEmbeddingBatcher:
+    """
+    在线查询场景下的动态微批处理
+    多个并发调用方各自提交一条文本, 批处理器最多等待 max_wait_ms 毫秒
+    或凑满 max_batch_size 条后合并为一次 /embeddings 请求, 再把向量分发给各调用方
+
+    用法:
+        async with AsyncEmbeddingBatcher(client) as batcher:
+            vector = await batcher.embed("query")
+    """
+    _STOP = object()
+
+    def __init__(self,
+                 client: EmbeddingClient,
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0,
+                 max_inflight: int = 4):
+        """
+        :param client: EmbeddingClient
+        :param max_batch_size: 单批最大条数
+        :param max_wait_ms: 第一条请求到达后最多等待的毫秒数
+        :param max_inflight: 同时在途的批次数
+        """
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_inflight = max_inflight
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+        self._closed = False
+        # client 基于 requests 是同步的, 放到线程池中执行, 不阻塞事件循环
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def start(self):
+        """
+        启动后台任务, close 之后可以再次调用 start 重新启动
+        """
+        self._closed = False
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_inflight)
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._inflight = asyncio.Semaphore(self.max_inflight)
+            self._worker = asyncio.create_task(self._run())
+
+    async def embed(self, text: str) -> np.ndarray:
+        """
+        :param text: 单条文本
+        :return: shape=(dimensions,) 的向量
+        """
+        if self._closed:
+            raise RuntimeError("AsyncEmbeddingBatcher is closed.")
+        if self._worker is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _collect(self):
+        """
+        收集一个批次: 阻塞等待第一条, 之后在截止时间内尽量凑满
+        :return: (batch, stop) stop 表示收到了 close 发出的结束标记
+        """
+        batch = []
+        item = await self._queue.get()
+        if item is self._STOP:
+            return batch, True
+        batch.append(item)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = await self._collect()
+            if not batch:
+                continue
+            await self._inflight.acquire()
+            task = asyncio.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch):
+        texts = [text for text, _ in batch]
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.client.embed, texts)
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(texts)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        finally:
+            self._inflight.release()
+
+    async def close(self):
+        """
+        处理完已提交的请求后停止后台任务, 之后的 embed 调用抛出 RuntimeError
+        """
+        self._closed = True
+        if self._worker is not None:
+            await self._queue.put(self._STOP)
+            try:
+                await self._worker
+            finally:
+                self._worker = None
+                # 后台任务异常退出时, 队列中剩余的请求不会再被处理
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if item is not self._STOP and not item[1].done():
+                        item[1].set_exception(RuntimeError("AsyncEmbeddingBatcher is closed."))
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+"""
+    内容寻址的Embedding持久化存储
+    键为 hash(model, dimensions, chunk text), 分块参数或子集变化后, 文本未变的分块不需要重新embedding
+    目录结构:
+        meta.json    模型名称与维度
+        keys.bin     每行16字节的哈希, 行号即向量所在行
+        vectors.f32  float32 向量, 通过 np.memmap 读取, 加载时不复制到内存
+    仅支持单进程写入, 多进程只读共享; 进程内多线程并发读写是安全的
+"""
+
+class EmbeddingStore:
+    KEY_SIZE = 16
+
+    def __init__(self, path: str, model: str, dimensions: int = 1024):
+        """
+        :param path: 存储目录
+        :param model: embedding模型名称, 不同模型的向量不能混用
+        :param dimensions: 向量维度
+        """
+        self.path = path
+        self.model = model
+        self.dimensions = dimensions
+        self._meta_path = os.path.join(path, "meta.json")
+        self._keys_path = os.path.join(path, "keys.bin")
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._lock = threading.Lock()
+        # 正在由某个线程请求的键, 其他线程等待其写入而不是重复请求
+        self._inflight: Dict[bytes, threading.Event] = {}
+        os.makedirs(path, exist_ok=True)
+        self._check_meta()
+        self._load()
+
+    def _check_meta(self):
+        meta = {"model": self.model, "dimensions": self.dimensions, "dtype": "float32"}
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored != meta:
+                logger.error(f"Embedding store {self.path} was built with {stored}, got {meta}.")
+                raise ValueError(f"Embedding store {self.path} was built with {stored}, got {meta}.")
+        else:
+            with open(self._meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+
+    def _load(self):
+        """
+        读取哈希索引并映射向量文件
+        写入中断时 keys 与 vectors 行数可能不一致, 以两者较小值为准
+        """
+        n_keys = os.path.getsize(self._keys_path) // self.KEY_SIZE \
+            if os.path.exists(self._keys_path) else 0
+        row_bytes = self.dimensions * 4
+        n_vectors = os.path.getsize(self._vectors_path) // row_bytes \
+            if os.path.exists(self._vectors_path) else 0
+        count = min(n_keys, n_vectors)
+
+        if count:
+            with open(self._keys_path, "rb") as f:
+                raw = f.read(count * self.KEY_SIZE)
+            size = self.KEY_SIZE
+            self._index = {raw[i * size:(i + 1) * size]: i for i in range(count)}
+        else:
+            self._index = {}
+        if n_keys != count or n_vectors != count:
+            logger.warning(f"Embedding store {self.path} is truncated to {count} rows.")
+            with open(self._keys_path, "ab") as f:
+                f.truncate(count * self.KEY_SIZE)
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(count * row_bytes)
+        self._count = count
+        self._remap()
+
+    def _remap(self):
+        if self._count:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                      shape=(self._count, self.dimensions))
+        else:
+            self._vectors = np.empty((0, self.dimensions), dtype=np.float32)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        只读的 memmap 向量矩阵
+        """
+        return self._vectors
+
+    def make_key(self, text: str) -> bytes:
+        return hashlib.blake2b(f"{self.model}\x00{self.dimensions}\x00{text}".encode("utf-8"),
+                               digest_size=self.KEY_SIZE).digest()
+
+    def _rows(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        在锁内取得行号与对应的向量矩阵, 两者保持一致
+        """
+        keys = [self.make_key(text) for text in texts]
+        with self._lock:
+            index = self._index
+            rows = np.fromiter((index.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+            return rows, self._vectors
+
+    def lookup(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: 每条文本对应的行号, 未命中为 -1
+        """
+        return self._rows(texts)[0]
+
+    def get(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        """
+        :return: (vectors, missing) 未命中的行为0, missing 为未命中文本的下标
+        """
+        rows, matrix = self._rows(texts)
+        out = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        hit = rows >= 0
+        if hit.any():
+            out[hit] = matrix[rows[hit]]
+        return out, np.flatnonzero(~hit).tolist()
+
+    def add(self, texts: List[str], vectors: np.ndarray):
+        """
+        追加新的向量, 已存在的文本会被跳过
+        向量写入并重新映射后才发布新的键, 读取方不会看到还不存在的行
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape != (len(texts), self.dimensions):
+            raise ValueError(f"Expected vectors of shape {(len(texts), self.dimensions)}, "
+                             f"got {vectors.shape}.")
+        with self._lock:
+            new_keys, new_rows, seen = [], [], set()
+            for i, text in enumerate(texts):
+                key = self.make_key(text)
+                if key in self._index or key in seen:
+                    continue
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(i)
+            if not new_keys:
+                return
+            # 先写向量再写键, 中断时多出来的向量会在下次加载时被截断
+            with open(self._vectors_path, "ab") as f:
+                f.write(np.ascontiguousarray(vectors[new_rows]).tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+            start = self._count
+            self._count += len(new_keys)
+            self._remap()
+            self._index.update((key, start + j) for j, key in enumerate(new_keys))
+
+    def embed(self, client, texts: List[str]) -> np.ndarray:
+        """
+        先查存储, 只把未命中的文本发送给服务端, 结果写回存储
+        多个线程共享同一个存储时, 同一文本只由第一个未命中的线程请求, 其余线程等待其写入
+        :param client: 提供 embed(texts) -> np.ndarray 的客户端, 如 EmbeddingClient
+        :param texts: 文本列表
+        :return: 与输入顺序一致的向量数组
+        """
+        out, missing = self.get(texts)
+        if missing:
+            # 同一批中重复的文本只请求一次
+            unique = {self.make_key(texts[i]): texts[i] for i in missing}
+            with self._lock:
+                owned = [key for key in unique if key not in self._index and key not in self._inflight]
+                waiting = [self._inflight[key] for key in unique if key in self._inflight]
+                done = threading.Event()
+                for key in owned:
+                    self._inflight[key] = done
+            try:
+                if owned:
+                    owned_texts = [unique[key] for key in owned]
+                    self.add(owned_texts, client.embed(owned_texts))
+            finally:
+                with self._lock:
+                    for key in owned:
+                        self._inflight.pop(key, None)
+                done.set()
+            for event in waiting:
+                event.wait()
+            vectors, still_missing = self.get([texts[i] for i in missing])
+            if still_missing:
+                # 其他线程的请求失败, 自己补上
+                retry = list(dict.fromkeys(texts[missing[j]] for j in still_missing))
+                self.add(retry, client.embed(retry))
+                vectors, _ = self.get([texts[i] for i in missing])
+            out[missing] = vectors
+        logger.debug(f"Embedding store: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        return out
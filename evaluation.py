@@ -0,0 +1,130 @@
+import os
+import csv
+import logging
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+from utils import iter_jsonl
+
+logger = logging.getLogger(__name__)
+"""
+    检索效果评估: nDCG@k, recall@k, MRR
+    检索结果整理为 (查询数, k) 的矩阵, 通过编码后的 (查询, 文档) 键与 qrels 做一次 searchsorted 匹配,
+    所有指标在整个矩阵上向量化计算, 与 pytrec_eval 一致使用线性增益
+"""
+
+def load_qrels(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    :param path: tsv/csv (query-id, corpus-id, score, 可有表头) 或 jsonl ({"query_id", "corpus_id", "score"})
+    :return: {query_id: {corpus_id: relevance}}
+    """
+    qrels: Dict[str, Dict[str, float]] = {}
+    if path.endswith(".jsonl"):
+        rows = ((r["query_id"], r["corpus_id"], r.get("score", 1)) for r in iter_jsonl(path))
+    else:
+        f = open(path, "r", encoding="utf-8", newline="")
+        rows = csv.reader(f, delimiter="," if path.endswith(".csv") else "\t")
+    for row in rows:
+        if len(row) < 2:
+            continue
+        try:
+            relevance = float(row[2]) if len(row) > 2 else 1.0
+        except ValueError:
+            # 表头
+            continue
+        qrels.setdefault(str(row[0]), {})[str(row[1])] = relevance
+    if not path.endswith(".jsonl"):
+        f.close()
+    logger.info(f"Loaded qrels for {len(qrels)} queries from {path}")
+    return qrels
+
+def rank_documents(hits: Sequence[dict], top_k: Optional[int] = None) -> List[str]:
+    """
+    分块级的检索结果转为文档级排序: 同一文档取排名最靠前的分块
+    :param hits: [{"id", "score", "metadata": {"doc_id", ...}}, ...], 按分数降序
+    """
+    docs = dict.fromkeys((hit.get("metadata") or {}).get("doc_id", hit["id"]) for hit in hits)
+    ranked = list(docs)
+    return ranked[:top_k] if top_k else ranked
+
+def evaluate(results: Dict[str, Sequence[str]],
+             qrels: Dict[str, Dict[str, float]],
+             k_values: Sequence[int] = (1, 5, 10, 100),
+             ndcg_k: Sequence[int] = (10,),
+             per_query: bool = False) -> dict:
+    """
+    :param results: {query_id: [corpus_id, ...]} 按相关性降序
+    :param qrels: load_qrels 的输出, 只评估 qrels 中有相关文档的查询
+    :param k_values: recall@k 的 k
+    :param ndcg_k: nDCG@k 的 k
+    :param per_query: 是否返回每个查询的指标数组
+    :return: {"ndcg@10": ..., "recall@k": ..., "mrr": ..., "queries": n}
+    """
+    query_ids = [qid for qid, rels in qrels.items() if any(r > 0 for r in rels.values())]
+    if not query_ids:
+        logger.warning("No relevant documents in qrels, nothing to evaluate.")
+        return {"queries": 0}
+    depth = max(max(k_values), max(ndcg_k))
+
+    # 文档编号, 只需要 qrels 中出现过的文档, 其余的增益为 0
+    doc_index: Dict[str, int] = {}
+    qrel_keys, qrel_gains = [], []
+    n_relevant = np.zeros(len(query_ids), dtype=np.float64)
+    ideal = np.zeros((len(query_ids), depth), dtype=np.float64)
+    for q, qid in enumerate(query_ids):
+        rels = sorted((r for r in qrels[qid].values() if r > 0), reverse=True)
+        n_relevant[q] = len(rels)
+        ideal[q, :min(len(rels), depth)] = rels[:depth]
+        for doc_id, relevance in qrels[qid].items():
+            qrel_keys.append((q, doc_index.setdefault(doc_id, len(doc_index))))
+            qrel_gains.append(relevance)
+    n_docs = len(doc_index) + 1
+    keys = np.array([q * n_docs + d for q, d in qrel_keys], dtype=np.int64)
+    order = np.argsort(keys)
+    keys, gains_sorted = keys[order], np.asarray(qrel_gains, dtype=np.float64)[order]
+
+    # 结果矩阵: 不在 qrels 中的文档编号为 n_docs - 1, 不足 depth 的位置为 -1
+    ranked = np.full((len(query_ids), depth), -1, dtype=np.int64)
+    missing = n_docs - 1
+    for q, qid in enumerate(query_ids):
+        row = [doc_index.get(doc_id, missing) for doc_id in list(results.get(qid, ()))[:depth]]
+        ranked[q, :len(row)] = row
+
+    matrix_keys = np.arange(len(query_ids), dtype=np.int64)[:, None] * n_docs + ranked
+    pos = np.clip(np.searchsorted(keys, matrix_keys), 0, len(keys) - 1)
+    found = (keys[pos] == matrix_keys) & (ranked >= 0)
+    gains = np.where(found, gains_sorted[pos], 0.0)
+    relevant = gains > 0
+
+    metrics = {"queries": len(query_ids)}
+    per_query_metrics = {}
+    discounts = 1.0 / np.log2(np.arange(2, depth + 2))
+    for k in ndcg_k:
+        dcg = gains[:, :k] @ discounts[:k]
+        idcg = ideal[:, :k] @ discounts[:k]
+        ndcg = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+        metrics[f"ndcg@{k}"] = float(ndcg.mean())
+        per_query_metrics[f"ndcg@{k}"] = ndcg
+    hits_cumulative = np.cumsum(relevant, axis=1)
+    for k in k_values:
+        recall = hits_cumulative[:, k - 1] / n_relevant
+        metrics[f"recall@{k}"] = float(recall.mean())
+        per_query_metrics[f"recall@{k}"] = recall
+    first = np.argmax(relevant, axis=1)
+    mrr = np.where(relevant.any(axis=1), 1.0 / (first + 1), 0.0)
+    metrics[f"mrr@{depth}"] = float(mrr.mean())
+    per_query_metrics[f"mrr@{depth}"] = mrr
+    if per_query:
+        metrics["per_query"] = {"query_ids": query_ids, **per_query_metrics}
+    return metrics
+
+def find_qrels(dataset_path: str, subset: str) -> Optional[str]:
+    """
+    在子集目录中查找 qrels 文件 (qrels.tsv / <subset>_qrels.tsv / ...)
+    """
+    directory = os.path.join(dataset_path, subset)
+    if not os.path.isdir(directory):
+        return None
+    for name in sorted(os.listdir(directory)):
+        if "qrels" in name.lower() and name.endswith((".tsv", ".csv", ".jsonl")):
+            return os.path.join(directory, name)
+    return None
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Union
+from langchain_openai import ChatOpenAI
+from context import (Passage, merge_passages, drop_near_duplicates, format_passage, render_prompt,
+                     pack_context)
+from embedding import _approx_token_count
+from llm_cache import LLMCache, abatch_cached
+from prompt_registry import get_registry
+
+logger = logging.getLogger(__name__)
+"""
+    生成答案, 检索到的上下文超过模型窗口时使用 map-reduce:
+        - map: 上下文按窗口大小分组, 每组抽取与问题相关的信息, 所有问题的所有分组通过一次 abatch 并发请求
+        - reduce: 汇总各组抽取的信息, 使用 generate 模版给出最终答案, 同样通过一次 abatch 并发请求
+          汇总结果仍超过窗口时, 对抽取结果再分组抽取, 最多 max_reduce_rounds 轮, 之后截断
+    总延迟通常为一次 map 调用加一次 reduce 调用
+    上下文能放进一个窗口的问题直接在 reduce 轮次中回答
+"""
+
+NONE_ANSWER = "NONE"
+
+def _truncate_tokens(text: str, max_tokens: int, token_counter: Callable[[str], int]) -> str:
+    """
+    按字符比例截断, 直到 token 数不超过 max_tokens
+    """
+    n_tokens = token_counter(text)
+    while text and n_tokens > max_tokens:
+        text = text[:int(len(text) * max(max_tokens, 0) / n_tokens * 0.95)]
+        n_tokens = token_counter(text)
+    return text
+
+def partition_passages(passages: Sequence[Passage], max_tokens: int,
+                       token_counter: Callable[[str], int] = _approx_token_count) -> List[List[Passage]]:
+    """
+    按顺序 (分数降序) 将段落装入不超过 max_tokens 的分组, 超过预算的单个段落截断后独占一组
+    """
+    groups, current, used = [], [], 0
+    for passage in passages:
+        n_tokens = token_counter(format_passage(len(current) + 1, passage)) + 1
+        if n_tokens > max_tokens:
+            text = passage.text
+            passage = passage._replace(text=_truncate_tokens(
+                text, token_counter(text) - (n_tokens - max_tokens), token_counter))
+            n_tokens = token_counter(format_passage(1, passage)) + 1
+        if current and used + n_tokens > max_tokens:
+            groups.append(current)
+            current, used = [], 0
+        current.append(passage)
+        used += n_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def _notes_to_passages(notes: Sequence[str]) -> List[Passage]:
+    return [Passage(f"part-{i}", [], f"Notes {i}", note, 0.0) for i, note in enumerate(notes, start=1)]
+
+def _prompt_tokens(template: str, passages: Sequence[Passage], question: str,
+                   token_counter: Callable[[str], int]) -> int:
+    return token_counter(render_prompt(template, [], question)) + \
+        sum(token_counter(format_passage(i, p)) + 1 for i, p in enumerate(passages, start=1))
+
+async def agenerate_answers(questions: Sequence[str],
+                            hits_list: Sequence[Sequence[dict]],
+                            llm: ChatOpenAI,
+                            subset: str,
+                            scores_list: Optional[Sequence[Sequence[float]]] = None,
+                            max_tokens: int = 3000,
+                            max_groups: int = 8,
+                            max_reduce_rounds: int = 3,
+                            max_concurrency: int = 8,
+                            cache: LLMCache = None,
+                            dedup_threshold: float = 0.8,
+                            token_counter: Callable[[str], int] = _approx_token_count,
+                            prompt_path: Union[str, Path] = Path("./prompt.json")) -> List[Optional[str]]:
+    """
+    :param questions: 原始查询
+    :param hits_list: 每个查询的检索结果
+    :param scores_list: 每个查询的 rerank 分数, 与 hits 一一对应
+    :param max_tokens: 单次调用的提示词 token 预算, 取决于模型窗口
+    :param max_groups: 每个查询最多的 map 分组数, 分数最低的分组被丢弃
+    :param max_reduce_rounds: 抽取结果汇总后仍超过 max_tokens 时, 最多再分组抽取的轮数, 之后截断
+    :param max_concurrency: 最大并发请求数, 取决于Qwen服务端允许的并发
+    :param cache: LLM响应缓存
+    :param token_counter: token计数函数, 与检索、分块阶段使用同一个 tokenizer 时预算最准确
+    :return: 每个查询的答案, 失败为 None
+    """
+    registry = get_registry(prompt_path)
+    generate_template = registry.get_template(("generate",), subset).text
+    map_template = registry.get_template(("generate_map",), subset).text
+    if scores_list is None:
+        scores_list = [None] * len(questions)
+
+    # ===== map =====
+    final_prompts: List[Optional[str]] = [None] * len(questions)
+    map_prompts, map_owner = [], []
+    for q, (question, hits, scores) in enumerate(zip(questions, hits_list, scores_list)):
+        passages = merge_passages(hits, scores)
+        if dedup_threshold is not None:
+            passages = drop_near_duplicates(passages, dedup_threshold)
+        if _prompt_tokens(generate_template, passages, question, token_counter) <= max_tokens:
+            final_prompts[q] = render_prompt(generate_template, passages, question)
+            continue
+        budget = max_tokens - token_counter(render_prompt(map_template, [], question))
+        groups = partition_passages(passages, budget, token_counter)
+        if len(groups) > max_groups:
+            logger.debug(f"Question {q}: {len(groups)} groups, keep the top {max_groups}.")
+            groups = groups[:max_groups]
+        for group in groups:
+            map_prompts.append(render_prompt(map_template, group, question))
+            map_owner.append(q)
+
+    # ===== reduce =====
+    # 汇总后的抽取结果仍超过预算时, 对抽取结果再分组抽取一轮, 每轮所有问题通过一次 abatch 请求
+    rounds = 0
+    while map_prompts:
+        rounds += 1
+        logger.info(f"Map-reduce round {rounds}: {len(map_prompts)} map calls for "
+                    f"{len(set(map_owner))}/{len(questions)} questions.")
+        notes = await abatch_cached(llm, map_prompts, max_concurrency, cache)
+        partials = {q: [] for q in map_owner}
+        for q, note in zip(map_owner, notes):
+            if note is None or note.strip().upper() == NONE_ANSWER:
+                continue
+            partials[q].append(note.strip())
+
+        map_prompts, map_owner = [], []
+        for q, q_notes in partials.items():
+            if not q_notes:
+                # 所有分组都没有抽取到信息, 退回到预算内分数最高的段落
+                final_prompts[q] = pack_context(hits_list[q], questions[q], subset, max_tokens,
+                                                scores_list[q], dedup_threshold, token_counter,
+                                                prompt_path).prompt
+                continue
+            parts = _notes_to_passages(q_notes)
+            if _prompt_tokens(generate_template, parts, questions[q], token_counter) <= max_tokens:
+                final_prompts[q] = render_prompt(generate_template, parts, questions[q])
+                continue
+            budget = max_tokens - token_counter(render_prompt(map_template, [], questions[q]))
+            groups = partition_passages(parts, budget, token_counter)
+            if rounds >= max_reduce_rounds or len(groups) >= len(parts):
+                # 轮数用尽或分组不再减少: 只保留预算内的抽取结果
+                budget = max_tokens - token_counter(render_prompt(generate_template, [], questions[q]))
+                # 单条抽取结果本身超过预算时已在分组中截断
+                kept = partition_passages(parts, budget, token_counter)[0]
+                logger.warning(f"Question {q}: notes exceed {max_tokens} tokens, "
+                               f"keep {len(kept)}/{len(parts)} notes.")
+                final_prompts[q] = render_prompt(generate_template, kept, questions[q])
+                continue
+            for group in groups:
+                map_prompts.append(render_prompt(map_template, group, questions[q]))
+                map_owner.append(q)
+
+    return await abatch_cached(llm, final_prompts, max_concurrency, cache)
+
+def generate_answers(questions: Sequence[str], hits_list: Sequence[Sequence[dict]], llm: ChatOpenAI,
+                     subset: str, **kwargs) -> List[Optional[str]]:
+    """
+    agenerate_answers 的同步版本
+    """
+    return asyncio.run(agenerate_answers(questions, hits_list, llm, subset, **kwargs))
@@ -0,0 +1,225 @@
+import time
+import queue
+import logging
+import threading
+import numpy as np
+from typing import Callable, Iterable, Optional
+from chunks import BaseOperator, to_chunk_records
+from embedding import EmbeddingClient
+from embedding_store import EmbeddingStore
+from vector_index import BaseVectorStore
+from utils import iter_jsonl, iter_batches
+from manifest import Manifest, hash_jsonl
+
+logger = logging.getLogger(__name__)
+"""
+    流式入库: corpus_prep.jsonl -> 分块 -> embedding -> 向量库
+    各阶段运行在独立线程中, 之间用有界队列连接:
+        - 下游变慢时上游阻塞 (背压), 内存占用与语料大小无关
+        - 各阶段互相重叠, 总耗时接近最慢的那个阶段
+"""
+
+_DONE = object()
+
+class _Pipeline:
+    """
+    管理阶段线程与异常传播: 任一阶段出错, 其余阶段尽快退出, 由调用方重新抛出
+    """
+    def __init__(self):
+        self.stop = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def fail(self, e: BaseException):
+        if self.error is None:
+            self.error = e
+        self.stop.set()
+
+    def put(self, q: queue.Queue, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+def iter_chunks(docs: Iterable[dict], operator: BaseOperator):
+    """
+    在当前线程中对每篇文档分块
+    :return: 生成器, {"id": "<doc_id>-<chunk_index>", "text": ..., "metadata": {...}}
+    """
+    for doc in docs:
+        yield from to_chunk_records(doc, operator.execute(doc["text"]))
+
+def ingest_corpus(corpus_path: str,
+                  operator: Optional[BaseOperator],
+                  client: EmbeddingClient,
+                  store: BaseVectorStore,
+                  embedding_store: Optional[EmbeddingStore] = None,
+                  embed_batch_size: int = 64,
+                  insert_batch_size: int = 2000,
+                  embed_workers: int = 2,
+                  queue_size: int = 8,
+                  docs: Optional[Iterable[dict]] = None,
+                  chunk_records: Optional[Iterable[dict]] = None) -> dict:
+    """
+    :param corpus_path: corpus_prep.jsonl 路径
+    :param operator: chunks.get_operator 得到的分块算子实例
+    :param client: embedding客户端
+    :param store: 向量库, NumpyVectorIndex 或 MilvusVectorStore
+    :param embedding_store: 可选的embedding缓存, 只对未命中的分块请求服务端
+    :param embed_batch_size: 每次embedding请求的分块数
+    :param insert_batch_size: 每次写入向量库的行数
+    :param embed_workers: 并发embedding的线程数, 共享 embedding_store, 同一文本只请求一次
+    :param queue_size: 阶段之间队列的最大批次数
+    :param docs: 直接传入文档迭代器时忽略 corpus_path
+    :param chunk_records: 已分块的记录 (如 chunks.chunk_corpus 的输出), 指定时不再使用 operator 分块
+    :return: 统计信息
+    """
+    pipeline = _Pipeline()
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    vector_queue = queue.Queue(maxsize=queue_size)
+    # doc_chunks: 每篇文档的分块编号上界, 增量入库时用于删除旧的分块
+    stats = {"chunks": 0, "inserted": 0, "doc_chunks": {}}
+    start_time = time.perf_counter()
+
+    def chunk_stage():
+        try:
+            if chunk_records is not None:
+                records = chunk_records
+            else:
+                records = iter_chunks(docs if docs is not None else iter_jsonl(corpus_path), operator)
+            for batch in iter_batches(records, embed_batch_size):
+                stats["chunks"] += len(batch)
+                if not pipeline.put(chunk_queue, batch):
+                    return
+        except BaseException as e:
+            logger.exception(f"Chunk stage failed: {e}")
+            pipeline.fail(e)
+        finally:
+            for _ in range(embed_workers):
+                pipeline.put(chunk_queue, _DONE)
+
+    def embed_stage():
+        try:
+            while True:
+                batch = pipeline.get(chunk_queue)
+                if batch is _DONE:
+                    return
+                texts = [record["text"] for record in batch]
+                if embedding_store is not None:
+                    vectors = embedding_store.embed(client, texts)
+                else:
+                    vectors = client.embed(texts)
+                if not pipeline.put(vector_queue, (batch, vectors)):
+                    return
+        except BaseException as e:
+            logger.exception(f"Embedding stage failed: {e}")
+            pipeline.fail(e)
+        finally:
+            pipeline.put(vector_queue, _DONE)
+
+    threads = [threading.Thread(target=chunk_stage, name="ingest-chunk", daemon=True)]
+    threads += [threading.Thread(target=embed_stage, name=f"ingest-embed-{i}", daemon=True)
+                for i in range(embed_workers)]
+    for thread in threads:
+        thread.start()
+
+    # 写入阶段在当前线程执行
+    pending_records, pending_vectors, pending = [], [], 0
+    def flush():
+        nonlocal pending_records, pending_vectors, pending
+        if not pending_records:
+            return
+        store.upsert([r["id"] for r in pending_records],
+                     np.concatenate(pending_vectors),
+                     [r["metadata"] for r in pending_records])
+        stats["inserted"] += len(pending_records)
+        doc_chunks = stats["doc_chunks"]
+        for record in pending_records:
+            doc_id, chunk_index = record["metadata"]["doc_id"], record["metadata"]["chunk_index"]
+            doc_chunks[doc_id] = max(doc_chunks.get(doc_id, 0), chunk_index + 1)
+        pending_records, pending_vectors, pending = [], [], 0
+
+    finished = 0
+    try:
+        while finished < embed_workers:
+            item = pipeline.get(vector_queue)
+            if item is _DONE:
+                if pipeline.stop.is_set():
+                    break
+                finished += 1
+                continue
+            batch, vectors = item
+            pending_records.extend(batch)
+            pending_vectors.append(vectors)
+            pending += len(batch)
+            if pending >= insert_batch_size:
+                flush()
+        if not pipeline.stop.is_set():
+            flush()
+    except BaseException as e:
+        pipeline.fail(e)
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if pipeline.error is not None:
+        logger.error(f"Ingestion of {corpus_path} failed: {pipeline.error}")
+        raise pipeline.error
+
+    if hasattr(store, "finalize"):
+        store.finalize()
+    stats["seconds"] = time.perf_counter() - start_time
+    logger.info(f"Ingested {corpus_path}: {stats['chunks']} chunks, "
+                f"{stats['inserted']} inserted in {stats['seconds']:.1f}s")
+    return stats
+
+def ingest_incremental(corpus_path: str,
+                       manifest: Manifest,
+                       operator: BaseOperator,
+                       client: EmbeddingClient,
+                       store: BaseVectorStore,
+                       fingerprint: Optional[str] = None,
+                       chunker: Optional[Callable[[Iterable[dict]], Iterable[dict]]] = None,
+                       **kwargs) -> dict:
+    """
+    根据清单增量入库: 只对新增或修改的文档重新分块、embedding、写入, 并删除修改或移除的文档的旧分块
+    :param manifest: 子集的增量处理清单
+    :param fingerprint: 分块算子、参数、embedding模型、向量库等的指纹, 变化时全部重建
+    :param chunker: 可选的批量分块函数 docs -> chunk records, 如基于 chunks.chunk_corpus 的并行分块
+    :param kwargs: 传给 ingest_corpus 的其他参数
+    """
+    hashes = hash_jsonl(corpus_path)
+    delta = manifest.diff("ingested", hashes, fingerprint)
+    if not delta:
+        logger.info(f"{corpus_path} is up to date, skip ingestion.")
+        return {"chunks": 0, "inserted": 0, "deleted": 0}
+    logger.info(f"Incremental ingestion for {corpus_path}: {delta}")
+
+    doc_chunks = dict(manifest.extra("ingested").get("doc_chunks", {}))
+    stale = [f"{doc_id}-{i}" for doc_id in delta.changed + delta.removed
+             for i in range(doc_chunks.pop(doc_id, 0))]
+    if stale:
+        store.delete(stale)
+
+    dirty = set(delta.dirty)
+    docs = (doc for doc in iter_jsonl(corpus_path) if doc["_id"] in dirty)
+    if chunker is not None:
+        stats = ingest_corpus(corpus_path, operator, client, store, chunk_records=chunker(docs), **kwargs)
+    else:
+        stats = ingest_corpus(corpus_path, operator, client, store, docs=docs, **kwargs)
+    doc_chunks.update(stats["doc_chunks"])
+
+    manifest.update("ingested", hashes, fingerprint, extra={"doc_chunks": doc_chunks})
+    manifest.save()
+    stats["deleted"] = len(stale)
+    return stats
@@ -0,0 +1,139 @@
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+from sqlite_cache import SQLiteCache
+
+logger = logging.getLogger(__name__)
+"""
+    LLM 响应的持久化缓存
+    以 (model, prompt) 的哈希为键, 存储在 SQLite 中 (见 sqlite_cache.SQLiteCache)
+    重复实验、中断后重跑、提示词未变的子集都不会再次调用 LLM
+"""
+
+class LLMCache(SQLiteCache):
+    """
+    基于 SQLite 的 LLM 响应缓存
+    淘汰策略:
+        - max_age: 超过该秒数的记录被删除, None 表示不过期
+        - max_entries: 记录数超过该值时, 按最近访问时间删除最旧的记录
+    """
+    TABLE = "llm_cache"
+    LABEL = "LLM cache"
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        )
+    """
+
+    def __init__(self,
+                 db_path: str = os.path.join("cache", "llm_cache.sqlite"),
+                 max_entries: Optional[int] = 100000,
+                 max_age: Optional[float] = None,
+                 evict_interval: int = 1000):
+        """
+        :param db_path: SQLite 文件路径, None 表示只缓存在内存中 (进程退出后丢失)
+        :param max_entries: 最大记录数
+        :param max_age: 记录最长保存时间(秒)
+        :param evict_interval: 每写入多少条记录执行一次淘汰
+        """
+        # 不使用磁盘时的内存缓存: key -> (response, created_at), 按最近访问排序
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        super().__init__(db_path, max_entries=max_entries, max_age=max_age, evict_interval=evict_interval)
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        return self.get_many(model, [prompt])[0]
+
+    def get_many(self, model: str, prompts: List[str]) -> List[Optional[str]]:
+        """
+        批量查询缓存
+        :return: 与 prompts 顺序一致的响应列表, 未命中为 None
+        """
+        keys = [self.make_key(model, prompt) for prompt in prompts]
+        found = {}
+        now = time.time()
+        with self._lock:
+            if self._conn is not None:
+                rows = self._select_many("response, created_at", keys)
+            else:
+                rows = [(key, *self._memory[key]) for key in keys if key in self._memory]
+            for key, response, created_at in rows:
+                if self.max_age is not None and now - created_at > self.max_age:
+                    continue
+                found[key] = response
+            if self._conn is not None:
+                self._touch(list(found), now)
+            else:
+                for key in found:
+                    self._memory.move_to_end(key)
+            self._count(sum(1 for key in keys if key in found), len(keys))
+        return [found.get(key) for key in keys]
+
+    def set(self, model: str, prompt: str, response: str):
+        self.set_many(model, [(prompt, response)])
+
+    def set_many(self, model: str, items: List[Tuple[str, str]]):
+        """
+        批量写入缓存
+        :param items: [(prompt, response), ...]
+        """
+        now = time.time()
+        if self._conn is None:
+            with self._lock:
+                for prompt, response in items:
+                    key = self.make_key(model, prompt)
+                    self._memory[key] = (response, now)
+                    self._memory.move_to_end(key)
+                while self.max_entries is not None and len(self._memory) > self.max_entries:
+                    self._memory.popitem(last=False)
+            return
+        self._insert_many([(self.make_key(model, prompt), model, response, now, now)
+                           for prompt, response in items])
+
+def model_name(llm) -> str:
+    """
+    缓存键使用的模型名称
+    """
+    return getattr(llm, "model_name", None) or type(llm).__name__
+
+async def abatch_cached(llm, prompts: List[str], max_concurrency: int = 8, cache: Optional[LLMCache] = None,
+                        on_error: Optional[Callable[[int, Exception], None]] = None) -> List[Optional[str]]:
+    """
+    通过 llm.abatch 并发调用, 只有未命中缓存的提示词会发送
+    :param on_error: 单个提示词失败时的回调 (下标, 异常), 默认记录错误日志
+    :return: 与 prompts 顺序一致的响应内容, 失败为 None
+    """
+    if cache is not None:
+        contents = cache.get_many(model_name(llm), prompts)
+    else:
+        contents = [None] * len(prompts)
+    miss_idx = [i for i, content in enumerate(contents) if content is None]
+    if miss_idx:
+        responses = await llm.abatch(
+            [prompts[i] for i in miss_idx],
+            config={"max_concurrency": max_concurrency},
+            return_exceptions=True,
+        )
+        new_items = []
+        for i, response in zip(miss_idx, responses):
+            if isinstance(response, Exception):
+                if on_error is not None:
+                    on_error(i, response)
+                else:
+                    logger.error(f"LLM call failed: {response}")
+                continue
+            contents[i] = response.content
+            new_items.append((prompts[i], response.content))
+        if cache is not None:
+            cache.set_many(model_name(llm), new_items)
+    return contents
@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from utils import iter_jsonl
+
+logger = logging.getLogger(__name__)
+"""
+    增量处理清单
+    每个处理阶段 (查询扩展 / 语料预处理 / 入库) 记录上次处理时每条记录的内容哈希,
+    下次运行只处理新增或修改的记录, 并删除已移除记录的产物
+    清单格式:
+    {
+        "<section>": {
+            "fingerprint": "处理参数的哈希, 变化时视为全部修改",
+            "hashes": {"<_id>": "<hash>", ...},
+            "extra": {...}
+        }
+    }
+"""
+
+def record_hash(record: dict, fields: Tuple[str, ...] = ("title", "text")) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for field in fields:
+        h.update(str(record.get(field, "")).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def hash_jsonl(file_path, fields: Tuple[str, ...] = ("title", "text"), id_key: str = "_id") -> Dict[str, str]:
+    """
+    流式计算jsonl文件中每条记录的哈希
+    :return: {_id: hash}
+    """
+    return {record[id_key]: record_hash(record, fields) for record in iter_jsonl(file_path)}
+
+def fingerprint(*parts) -> str:
+    """
+    处理参数的指纹, 如 prompt模版、模型名称、分块参数
+    """
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+class Delta(NamedTuple):
+    added: List[str]
+    changed: List[str]
+    removed: List[str]
+    unchanged: List[str]
+
+    @property
+    def dirty(self) -> List[str]:
+        """
+        需要重新处理的记录
+        """
+        return self.added + self.changed
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self):
+        return (f"{len(self.added)} added, {len(self.changed)} changed, "
+                f"{len(self.removed)} removed, {len(self.unchanged)} unchanged")
+
+class Manifest:
+    def __init__(self, path: str):
+        self.path = path
+        self._sections: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._sections = json.load(f)
+
+    @classmethod
+    def for_subset(cls, dataset_path: str, subset: str) -> "Manifest":
+        return cls(os.path.join(dataset_path, subset, "manifest.json"))
+
+    def diff(self, section: str, hashes: Dict[str, str], fingerprint: Optional[str] = None) -> Delta:
+        """
+        比较当前记录与上次处理时的记录
+        指纹变化时, 之前的所有记录都视为已移除, 当前记录都视为新增
+        """
+        previous = self._sections.get(section)
+        if previous is None:
+            return Delta(list(hashes), [], [], [])
+        old = previous["hashes"]
+        if previous.get("fingerprint") != fingerprint:
+            logger.info(f"Manifest section {section}: fingerprint changed, rebuild all.")
+            return Delta(list(hashes), [], list(old), [])
+
+        added, changed, unchanged = [], [], []
+        for _id, h in hashes.items():
+            if _id not in old:
+                added.append(_id)
+            elif old[_id] != h:
+                changed.append(_id)
+            else:
+                unchanged.append(_id)
+        removed = [_id for _id in old if _id not in hashes]
+        return Delta(added, changed, removed, unchanged)
+
+    def has_section(self, section: str) -> bool:
+        return section in self._sections
+
+    def extra(self, section: str) -> dict:
+        return self._sections.get(section, {}).get("extra", {})
+
+    def update(self, section: str, hashes: Dict[str, str], fingerprint: Optional[str] = None,
+               extra: Optional[dict] = None):
+        self._sections[section] = {
+            "fingerprint": fingerprint,
+            "hashes": hashes,
+            "extra": extra if extra is not None else self.extra(section),
+        }
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._sections, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
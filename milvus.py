@@ -1,28 +1,257 @@
-from pymilvus import connections, Collection, utility
+from pymilvus import connections, Collection, CollectionSchema, FieldSchema, DataType, utility
+import os
+import json
+import itertools
 import logging
-# TODO: 代码重构
+import threading
+import numpy as np
+from typing import Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from vector_index import BaseVectorStore
+from utils import iter_batches
+import tracing
 
 logger = logging.getLogger(__name__)
+"""
+    Milvus 连接管理与知识库增删查改
+    - 导入本模块不会连接数据库, 第一次使用时才建立连接
+    - 连接参数来自 config/milvus.yaml, 环境变量 MILVUS_* 优先
+    - 批量 upsert 只写入数据, flush 与建索引推迟到 finalize 统一执行
+"""
+
+DEFAULT_MILVUS_CONFIG = {
+    "host": "localhost",
+    "port": "19530",
+    "user": "",
+    "password": "",
+    "secure": False,
+    "alias": "frag",
+    "pool_size": 1,
+    "timeout": 10.0,
+}
+
+class MilvusConnectionManager:
+    """
+    惰性连接 + 连接别名池
+    pool_size > 1 时创建多个别名 (frag-0, frag-1, ...), 供并发写入的线程轮流使用
+    """
+    def __init__(self, config: Optional[dict] = None):
+        config = {**DEFAULT_MILVUS_CONFIG, **(config or {})}
+        for key in ("host", "port", "user", "password"):
+            env_value = os.getenv(f"MILVUS_{key.upper()}")
+            if env_value:
+                config[key] = env_value
+        self.config = config
+        self.aliases = [f"{config['alias']}-{i}" for i in range(max(1, int(config["pool_size"])))]
+        self._connected = set()
+        self._lock = threading.Lock()
+        self._cycle = itertools.cycle(self.aliases)
+
+    def _connect(self, alias: str):
+        connections.connect(
+            alias=alias,
+            host=self.config["host"],
+            port=str(self.config["port"]),
+            user=self.config["user"],
+            password=self.config["password"],
+            secure=self.config["secure"],
+            timeout=self.config["timeout"],
+        )
+        # 检查连接是否成功
+        if not connections.has_connection(alias):
+            logger.error(f"Failed to connect to Milvus ({alias}).")
+            raise ConnectionError(f"Failed to connect to Milvus ({alias}).")
+        logger.info(f"Connected to Milvus {self.config['host']}:{self.config['port']} as {alias}.")
+
+    def get_alias(self, alias: Optional[str] = None) -> str:
+        """
+        获取一个已连接的别名, 未指定时轮询连接池
+        """
+        with self._lock:
+            if alias is None:
+                alias = next(self._cycle)
+            if alias not in self._connected:
+                self._connect(alias)
+                self._connected.add(alias)
+        return alias
+
+    def close(self):
+        with self._lock:
+            for alias in self._connected:
+                connections.disconnect(alias)
+            self._connected.clear()
+
+_MANAGERS = {}
+_MANAGERS_LOCK = threading.Lock()
+
+def get_connection_manager(config: Optional[dict] = None) -> MilvusConnectionManager:
+    """
+    同一组连接参数在进程内共享一个连接管理器
+    """
+    key = tuple(sorted({**DEFAULT_MILVUS_CONFIG, **(config or {})}.items()))
+    with _MANAGERS_LOCK:
+        if key not in _MANAGERS:
+            _MANAGERS[key] = MilvusConnectionManager(config)
+        return _MANAGERS[key]
 
-# 连接到 Milvus 数据库
-connections.connect(
-    alias="test",
-    host="10.16.41.190",
-    port="19530",
-    user="root",
-    password="Ydkj.nlp@2024",
-    secure=False
-)
-# 检查连接是否成功
-if connections.has_connection("test"):
-    logger.info("Connected to Milvus successfully.")
-else:
-    logger.error("Failed to connect to Milvus.")
-    raise ConnectionError("Failed to connect to Milvus.")
 # 创建知识库
 #####
 # 因为已经在前端创建了知识库，xxx
+# 若集合不存在, MilvusVectorStore 会按下面的 schema 创建
 #####
+def _id_filter(ids: List[str]) -> str:
+    """
+    构造 Milvus 的 id in [...] 过滤表达式
+    字符串按 JSON 规则加双引号并转义 (引号、反斜杠、控制字符), 与 Milvus 表达式的字符串字面量语法一致
+    """
+    return "id in [" + ", ".join(json.dumps(str(_id), ensure_ascii=False) for _id in ids) + "]"
+
+class MilvusVectorStore(BaseVectorStore):
+    """
+    基于 Milvus 集合的向量存储, 与 NumpyVectorIndex 使用相同的检索接口
+    schema: id (VARCHAR, 主键) | vector (FLOAT_VECTOR) | metadata (JSON)
+    """
+    DEFAULT_INDEX_PARAMS = {"index_type": "HNSW", "metric_type": "COSINE",
+                            "params": {"M": 16, "efConstruction": 200}}
+
+    def __init__(self,
+                 manager: MilvusConnectionManager,
+                 collection_name: str,
+                 dimensions: int = 1024,
+                 index_params: Optional[dict] = None,
+                 search_params: Optional[dict] = None,
+                 id_max_length: int = 512):
+        """
+        :param manager: 连接管理器
+        :param collection_name: 集合名称
+        :param dimensions: 向量维度
+        :param index_params: 向量索引参数
+        :param search_params: 检索参数
+        """
+        self.manager = manager
+        self.collection_name = collection_name
+        self.dimensions = dimensions
+        self.index_params = index_params or self.DEFAULT_INDEX_PARAMS
+        self.search_params = search_params or {"metric_type": self.index_params["metric_type"],
+                                               "params": {"ef": 64}}
+        self.id_max_length = id_max_length
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _schema(self) -> CollectionSchema:
+        return CollectionSchema([
+            FieldSchema("id", DataType.VARCHAR, is_primary=True, max_length=self.id_max_length),
+            FieldSchema("vector", DataType.FLOAT_VECTOR, dim=self.dimensions),
+            FieldSchema("metadata", DataType.JSON),
+        ], description="FinanceRAG chunks")
+
+    def collection(self, alias: Optional[str] = None) -> Collection:
+        """
+        每个连接别名缓存一个 Collection 对象, 集合不存在时创建
+        """
+        alias = self.manager.get_alias(alias)
+        with self._lock:
+            if alias not in self._collections:
+                if utility.has_collection(self.collection_name, using=alias):
+                    self._collections[alias] = Collection(self.collection_name, using=alias)
+                else:
+                    logger.info(f"Creating collection {self.collection_name}.")
+                    self._collections[alias] = Collection(
+                        self.collection_name, schema=self._schema(), using=alias)
+            return self._collections[alias]
+
+    # ===== 增删改 =====
+    def upsert(self, ids: List[str], vectors: np.ndarray, metadata: Optional[List[dict]] = None,
+               batch_size: int = 5000, max_workers: int = 1):
+        """
+        批量写入, 不触发 flush, 写入结束后调用 finalize
+        :param batch_size: 单次 upsert 的行数
+        :param max_workers: 并发写入的线程数, 每个线程使用连接池中的不同别名
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if metadata is None:
+            metadata = [{} for _ in ids]
+        batches = [(ids[start:start + batch_size],
+                    vectors[start:start + batch_size],
+                    metadata[start:start + batch_size])
+                   for start in range(0, len(ids), batch_size)]
+        self._write_batches(batches, max_workers)
+
+    def bulk_upsert(self, records: Iterable[dict], batch_size: int = 5000, max_workers: int = 1) -> int:
+        """
+        流式批量写入
+        :param records: 生成器, 每条为 {"id": str, "vector": array-like, "metadata": dict}
+        :return: 写入的行数
+        """
+        total = 0
+        def batches():
+            nonlocal total
+            for batch in iter_batches(records, batch_size):
+                total += len(batch)
+                yield ([r["id"] for r in batch],
+                       np.asarray([r["vector"] for r in batch], dtype=np.float32),
+                       [r.get("metadata", {}) for r in batch])
+        self._write_batches(batches(), max_workers)
+        return total
+
+    def _write_batch(self, batch, alias: Optional[str] = None):
+        ids, vectors, metadata = batch
+        self.collection(alias).upsert([list(ids), vectors.tolist(), list(metadata)])
+
+    def _write_batches(self, batches, max_workers: int):
+        if max_workers <= 1:
+            for batch in batches:
+                self._write_batch(batch)
+            return
+        aliases = self.manager.aliases
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = []
+            for i, batch in enumerate(batches):
+                pending.append(executor.submit(self._write_batch, batch, aliases[i % len(aliases)]))
+                # 限制在途批次数量, 避免生成器被一次性读完
+                if len(pending) >= max_workers * 2:
+                    pending.pop(0).result()
+            for future in pending:
+                future.result()
+
+    def delete(self, ids: List[str], batch_size: int = 1000):
+        for start in range(0, len(ids), batch_size):
+            part = ids[start:start + batch_size]
+            self.collection().delete(_id_filter(part))
+
+    def finalize(self):
+        """
+        写入结束后统一 flush、建索引并加载到内存
+        """
+        alias = self.manager.get_alias()
+        collection = self.collection(alias)
+        collection.flush()
+        if not collection.has_index():
+            logger.info(f"Building index on {self.collection_name}: {self.index_params}")
+            collection.create_index("vector", self.index_params)
+            utility.wait_for_index_building_complete(self.collection_name, using=alias)
+        collection.load()
+        self._loaded = True
 
-# 管理知识库
-# 增删查改
+    # ===== 查询 =====
+    @tracing.traced("vector_search", backend="milvus")
+    def search(self, query_vectors: np.ndarray, top_k: int = 10, expr: Optional[str] = None) -> List[List[dict]]:
+        collection = self.collection()
+        if not self._loaded:
+            collection.load()
+            self._loaded = True
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        if query_vectors.ndim == 1:
+            query_vectors = query_vectors[None, :]
+        hits = collection.search(
+            data=query_vectors.tolist(),
+            anns_field="vector",
+            param=self.search_params,
+            limit=top_k,
+            expr=expr,
+            output_fields=["metadata"],
+        )
+        return [[{"id": hit.id, "score": float(hit.distance),
+                  "metadata": hit.fields.get("metadata") or {}} for hit in result]
+                for result in hits]
@@ -2,10 +2,15 @@ import shutil
 import os 
 import re 
 import json
-import jsonlines
+import asyncio
 import logging
 from langchain_openai import ChatOpenAI
 from pathlib import Path
+from utils import iter_jsonl, iter_batches, JsonlWriter
+from llm_cache import LLMCache, model_name, abatch_cached
+from prompt_registry import get_registry
+from manifest import Manifest, hash_jsonl, fingerprint
+from corpus_index import CorpusReader
 
 logger = logging.getLogger(__name__)
 """
@@ -13,88 +18,211 @@ logger = logging.getLogger(__name__)
     TODO: 2025-7-28
     Corpus的处理方式 表格·图片·关键词等等。
 """
-def load_prompt(subset, prompt_path=Path("./prompts"), key="queries") -> str:
+def load_prompt(subset, prompt_path=Path("./prompt.json"), key="queries") -> str:
     """
     加载提示词
+    通过进程内共享的 PromptRegistry 读取, 文件只在修改后重新解析
     :param subset: 数据集子集名称
     :param prompt_path: 提示词路径
     :param key: 提示词键
-    :return: 提示词内容
+    :return: 提示词内容, 共享前缀在前、子集特有内容在后
     """
-    if not prompt_path.exists():
-        logger.error(f"Prompt file {prompt_path} does not exist.")
-        raise FileNotFoundError(f"Prompt file {prompt_path} does not exist.")
-    
-    with open(prompt_path, 'r', encoding='utf-8') as file:
-        prompts = json.load(file)["pre_retrieval"][key]
-    if subset not in prompts:
-        logger.error(f"Subset {subset} not found in prompts.")
-        raise KeyError(f"Subset {subset} not found in prompts.")
-    
-    return prompts[subset]
+    return get_registry(prompt_path).get(("pre_retrieval", key), subset)
 
 def load_jsonl(file_path):
     """
     加载jsonl文件
+    大文件请使用 utils.iter_jsonl 流式读取
     :param file_path: jsonl文件路径
     :return: jsonl数据列表
     """
-    if not os.path.exists(file_path):
-        logger.error(f"File {file_path} does not exist.")
-        raise FileNotFoundError(f"File {file_path} does not exist.")
-    
-    data = []
-    with jsonlines.open(file_path) as reader:
-        for obj in reader:
-            data.append(obj)
-    return data
+    return list(iter_jsonl(file_path))
 
 def save_jsonl(data, file_path):
     """
     保存数据为jsonl格式
-    :param data: 数据列表
+    :param data: 数据列表或生成器
     :param file_path: 保存路径
     """
     # if not data:
     #     raise ValueError("Data is empty, nothing to save.")
     
-    with jsonlines.open(file_path, mode='w') as writer:
-        for item in data:
-            writer.write(item)
+    with JsonlWriter(file_path) as writer:
+        writer.write_all(data)
     logger.info(f"Data saved to {file_path}")
 
-def expand_queries(subset, dataset_path, llm:ChatOpenAI):
+def expand_queries(subset, dataset_path, llm:ChatOpenAI, max_concurrency=1, batch_size=256,
+                   cache:LLMCache=None, manifest:Manifest=None):
     """
     扩展查询  提取Query中的关键词,作为Query的补充内容
+    流式读取 queries.jsonl, 每扩展完一批就追加写入, 内存占用与查询数量无关
     :param subset: 数据集子集名称
     :param dataset_path: 数据集路径
     :param llm: LLM模型
+    :param max_concurrency: 并发请求数, 1 表示逐条调用; >1 时使用 llm.abatch 并发扩展
+    :param batch_size: 并发模式下每批读取的查询数量
+    :param cache: LLM响应缓存, None 表示不使用缓存
+    :param manifest: 增量处理清单; 指定时只扩展新增或修改的查询, 其余沿用已有结果
     """
-    # 若文件过大，需要改为流处理方式
+    save_path = Path(f"{dataset_path}/{subset}/expanded_queries.jsonl")
+    queries_path = os.path.join(dataset_path, subset, "queries.jsonl")
     prompt_templete = load_prompt(subset)
-    queries_data = load_jsonl(os.path.join(dataset_path, subset, "queries.jsonl"))
+
+    previous, reuse = None, set()
+    if manifest is not None:
+        hashes = hash_jsonl(queries_path)
+        query_fingerprint = fingerprint(prompt_templete, model_name(llm))
+        if save_path.is_file() and not manifest.has_section("queries"):
+            # 第一次使用清单: 沿用已有的扩展结果
+            with CorpusReader(str(save_path)) as existing:
+                manifest.update("queries", {_id: h for _id, h in hashes.items() if _id in existing},
+                                query_fingerprint)
+        delta = manifest.diff("queries", hashes, query_fingerprint)
+        if save_path.is_file():
+            if not delta:
+                logger.info(f"{save_path} is up to date, skip query expansion.")
+                return
+            previous, reuse = CorpusReader(str(save_path)), set(delta.unchanged)
+        logger.info(f"Query expansion for {subset}: {delta}")
+    elif save_path.is_file():
+        logger.info(f"{save_path} already exists, skip query expansion.")
+        return
+
+    def reused(query):
+        if query["_id"] in reuse:
+            return previous.get(query["_id"])
+        return None
+
+    queries_data = iter_jsonl(queries_path)
+    # 扩展失败的查询不记入清单, 下次增量运行时重试
+    failed = set()
+    # 先写临时文件, 完成后再重命名, 避免中断后留下不完整的结果
+    tmp_path = save_path.with_suffix(".jsonl.tmp")
+    try:
+        with JsonlWriter(tmp_path) as writer:
+            if max_concurrency > 1:
+                asyncio.run(_aexpand_to_writer(
+                    queries_data, llm, prompt_templete, writer, max_concurrency, batch_size, cache,
+                    reused, failed))
+            else:
+                for query in queries_data:
+                    old = reused(query)
+                    if old is not None:
+                        writer.write(old)
+                        continue
+                    # 使用llm模型生成扩展查询
+                    query_text = query["text"]
+                    # prompt_templete ... \n\n# Query\n
+                    prompt = f"{prompt_templete}{query_text}"
+
+                    try:
+                        new_query = _invoke_cached(llm, prompt, cache)
+                    except Exception as e:
+                        # 与 expand_query_stream 一致: 单个查询失败时保留原始查询
+                        logger.error(f"Error expanding query {query['_id']}: {e}")
+                        failed.add(query["_id"])
+                        writer.write(query)
+                        continue
+                    writer.write(_merge_expansion(query, new_query))
+    except BaseException:
+        # 写入失败时不留下不完整的临时文件
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    finally:
+        if previous is not None:
+            previous.close()
+    os.replace(tmp_path, save_path)
+    logger.info(f"Data saved to {save_path}")
+    if manifest is not None:
+        if failed:
+            logger.warning(f"{len(failed)} queries of {subset} failed to expand, retry on the next run.")
+        manifest.update("queries", {_id: h for _id, h in hashes.items() if _id not in failed},
+                        query_fingerprint)
+        manifest.save()
+
+async def _aexpand_to_writer(queries, llm:ChatOpenAI, prompt_templete, writer:JsonlWriter,
+                             max_concurrency, batch_size, cache=None, reused=None, failed=None):
+    """
+    在同一个事件循环中分批扩展查询并写入 writer
+    :param reused: 返回可沿用的已有结果的函数, 返回 None 的查询才会调用LLM
+    :param failed: 收集扩展失败的查询 _id 的集合
+    """
+    for batch in iter_batches(queries, batch_size):
+        results = [reused(query) if reused else None for query in batch]
+        todo = [i for i, result in enumerate(results) if result is None]
+        if todo:
+            expanded = await aexpand_queries(
+                [batch[i] for i in todo], llm, prompt_templete, max_concurrency, cache)
+            for i, result in zip(todo, expanded):
+                # aexpand_queries 失败时原样返回输入的查询
+                if result is batch[i] and failed is not None:
+                    failed.add(batch[i]["_id"])
+                results[i] = result
+        writer.write_all(results)
+
+def _invoke_cached(llm:ChatOpenAI, prompt, cache:LLMCache=None) -> str:
+    """
+    调用LLM, 命中缓存时直接返回缓存结果
+    """
+    if cache is not None:
+        cached = cache.get(model_name(llm), prompt)
+        if cached is not None:
+            return cached
+    response = llm.invoke(prompt).content
+    if cache is not None:
+        cache.set(model_name(llm), prompt, response)
+    return response
+
+async def _ainvoke_cached(llm:ChatOpenAI, prompt, cache:LLMCache=None) -> str:
+    if cache is not None:
+        cached = cache.get(model_name(llm), prompt)
+        if cached is not None:
+            return cached
+    response = (await llm.ainvoke(prompt)).content
+    if cache is not None:
+        cache.set(model_name(llm), prompt, response)
+    return response
+
+def _merge_expansion(query, new_query):
+    """
+    将LLM生成的关键词拼接到原始查询之前
+    :param query: 原始查询
+    :param new_query: LLM生成的关键词
+    :return: 扩展后的查询
+    """
+    return {
+        "_id": query["_id"],
+        "title": query["title"],
+        "text": f"{new_query}\n\n{query['text']}",
+    }
+
+async def aexpand_queries(queries, llm:ChatOpenAI, prompt_templete, max_concurrency=8,
+                          cache:LLMCache=None):
+    """
+    并发扩展一批查询, 基于 llm.abatch, 输出顺序与输入一致
+    单个查询失败时与 expand_query_stream 一致: 记录错误并返回原始查询
+    :param queries: 查询列表
+    :param llm: LLM模型
+    :param prompt_templete: 提示模版
+    :param max_concurrency: 最大并发请求数, 取决于Qwen服务端允许的并发
+    :param cache: LLM响应缓存, 只有未命中的查询会发送给LLM
+    :return: 扩展后的查询列表
+    """
+    prompts = [f"{prompt_templete}{query['text']}" for query in queries]
+    contents = await abatch_cached(
+        llm, prompts, max_concurrency, cache,
+        on_error=lambda i, e: logger.error(f"Error expanding query {queries[i]['_id']}: {e}"))
 
     expanded_queries = []
-    for query in queries_data:
-        # 使用llm模型生成扩展查询
-        query_text = query["text"]
-        # prompt_templete ... \n\n# Query\n
-        prompt = f"{prompt_templete}{query_text}"
-
-        new_query = llm.invoke(prompt).content
-
-        expanded_queries.append({
-            "_id": query["id"],
-            "title": query["title"],
-            "text": f"{new_query}\n\n{query_text}",
-        })
-    
-    # 保存扩展查询
-    save_path = Path(f"{dataset_path}/{subset}/expanded_queries.jsonl")
-    if not save_path.is_file():
-        save_jsonl(expanded_queries, save_path)
+    for query, content in zip(queries, contents):
+        if content is None:
+            expanded_queries.append(query)
+            continue
+        expanded_queries.append(_merge_expansion(query, content))
+    return expanded_queries
 
-def expand_query_stream(query, llm:ChatOpenAI, subset):
+def expand_query_stream(query, llm:ChatOpenAI, subset, cache:LLMCache=None):
     """
     扩展单个查询
     :param query: {
@@ -105,52 +233,128 @@ def expand_query_stream(query, llm:ChatOpenAI, subset):
     :param subset: 数据集子集名称
     :param llm: LLM模型
     :param subset: 提示模版类型
+    :param cache: LLM响应缓存, None 表示不使用缓存
     :return: 扩展后的查询
     """
     prompt_templete = load_prompt(subset)
     prompt = f"{prompt_templete}{query['text']}"
     
     try:
-        new_query = llm.invoke(prompt).content
-        return {
-            "_id": query["_id"],
-            "title": query["title"],
-            "text": f"{new_query}\n\n{query['text']}",
-        }
+        new_query = _invoke_cached(llm, prompt, cache)
+        return _merge_expansion(query, new_query)
+    except Exception as e:
+        logger.error(f"Error expanding query {query['_id']}: {e}")
+        return query
+
+async def aexpand_query_stream(query, llm:ChatOpenAI, subset, semaphore:asyncio.Semaphore=None,
+                              cache:LLMCache=None):
+    """
+    异步扩展单个查询, 可与其他查询共享 semaphore 以限制并发
+    :param query: 同 expand_query_stream
+    :param llm: LLM模型
+    :param subset: 提示模版类型
+    :param semaphore: 并发限制, None 表示不限制
+    :param cache: LLM响应缓存, None 表示不使用缓存
+    :return: 扩展后的查询, 失败时返回原始查询
+    """
+    prompt_templete = load_prompt(subset)
+    prompt = f"{prompt_templete}{query['text']}"
+
+    try:
+        if semaphore is None:
+            new_query = await _ainvoke_cached(llm, prompt, cache)
+        else:
+            async with semaphore:
+                new_query = await _ainvoke_cached(llm, prompt, cache)
+        return _merge_expansion(query, new_query)
     except Exception as e:
         logger.error(f"Error expanding query {query['_id']}: {e}")
         return query
 
-def copy_corpus(subset, dataset_path):
+def copy_corpus(subset, dataset_path, preprocess=None, manifest:Manifest=None):
+    """
+    生成预处理后的语料 corpus_prep.jsonl
+    :param subset: 数据集子集名称
+    :param dataset_path: 数据集路径
+    :param preprocess: 对单条语料的处理函数, None 表示直接复制
+    :param manifest: 增量处理清单; 语料未变化时跳过, 只对新增或修改的文档调用 preprocess
+    :return: 与上次处理相比的 Delta, 未使用清单时为 None
+    """
     from_path = os.path.join(dataset_path, subset, 'corpus.jsonl')
     to_path = os.path.join(dataset_path, subset, 'corpus_prep.jsonl')
-    shutil.copy(from_path, to_path)
 
-def pre_retrieve(dataset_path, llm:ChatOpenAI):
+    delta = None
+    if manifest is not None:
+        hashes = hash_jsonl(from_path)
+        corpus_fingerprint = fingerprint(getattr(preprocess, "__qualname__", None))
+        delta = manifest.diff("corpus", hashes, corpus_fingerprint)
+        if os.path.exists(to_path) and not delta:
+            logger.info(f"{to_path} is up to date, skip corpus preprocessing.")
+            return delta
+        logger.info(f"Corpus preprocessing for {subset}: {delta}")
+
+    if preprocess is None:
+        shutil.copyfile(from_path, to_path)
+    else:
+        previous, reuse = None, set()
+        if delta is not None and delta.unchanged and os.path.exists(to_path):
+            previous, reuse = CorpusReader(to_path), set(delta.unchanged)
+        # 逐条处理并写入, 不把整个语料加载到内存中
+        tmp_path = f"{to_path}.tmp"
+        try:
+            with JsonlWriter(tmp_path) as writer:
+                for doc in iter_jsonl(from_path):
+                    old = previous.get(doc["_id"]) if doc["_id"] in reuse else None
+                    writer.write(old if old is not None else preprocess(doc))
+        finally:
+            if previous is not None:
+                previous.close()
+        os.replace(tmp_path, to_path)
+
+    if manifest is not None:
+        manifest.update("corpus", hashes, corpus_fingerprint)
+        manifest.save()
+    return delta
+
+DEFAULT_SUBSETS = [
+    # "FinanceBench",
+    # "FinDER",
+    # "FinQABench",
+    # "MultiHiertt",
+    # "ConvFinQA",
+    # "TATQA",
+    "FinQA_corpus",
+]
+
+def pre_retrieve(dataset_path, llm:ChatOpenAI, max_concurrency=1, cache:LLMCache=None, subsets=None,
+                 incremental=True):
     # load env, 需要使用模型预处理数据集
     # config 文件中与 env文件中有冲突，可以选择将重要信息从config文件中提取出来，放到.env文件中。
     # 针对不同的数据集有不一样的处理方法
     # 特别是针对Mluti-hop数据集
     # 表格处理
-    subsets = [
-        # "FinanceBench",
-        # "FinDER",
-        # "FinQABench",
-        # "MultiHiertt",
-        # "ConvFinQA",
-        # "TATQA",
-        "FinQA_corpus",
-    ]
+    # incremental: 使用 <subset>/manifest.json 只处理变化的查询和语料
+    # 返回处理失败的子集 {subset: 异常}, 某个子集失败不影响其他子集
+    if subsets is None:
+        subsets = DEFAULT_SUBSETS
+    failures = {}
     for subset in subsets:
         try: 
+            manifest = Manifest.for_subset(dataset_path, subset) if incremental else None
             # 处理query扩展
-            expand_queries(subset, dataset_path, llm)
+            expand_queries(subset, dataset_path, llm, max_concurrency=max_concurrency, cache=cache,
+                           manifest=manifest)
             # 处理corpus扩展
-            # TODO: 如何处理corpus中的表格数据？ 图片数据？
-            copy_corpus(subset, dataset_path)
+            # 表格数据在入库分块时由 chunks.TableSplitter (chunk_operator: table-splitter) 处理
+            # TODO: 图片数据？
+            copy_corpus(subset, dataset_path, manifest=manifest)
         except Exception as e:
             logger.error(f"Error processing subset {subset}: {e}")
+            failures[subset] = e
             continue
+    if cache is not None:
+        cache.report()
+    return failures
 
 
     
\ No newline at end of file
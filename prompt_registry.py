@@ -0,0 +1,112 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, NamedTuple, Tuple, Union
+
+logger = logging.getLogger(__name__)
+"""
+    进程内共享的提示词注册表
+    prompt.json 只在第一次使用或文件修改(mtime变化)后解析一次
+    同一分组下的模版拆分为 共享静态前缀 + 子集后缀, 拼接查询时前缀保持逐字节一致,
+    便于推理服务命中 prefix/KV cache, 降低首 token 延迟
+"""
+
+class PromptTemplate(NamedTuple):
+    """
+    prefix: 同一分组内所有子集共享的静态前缀
+    suffix: 子集特有的部分
+    """
+    prefix: str
+    suffix: str
+
+    @property
+    def text(self) -> str:
+        return self.prefix + self.suffix
+
+    def render(self, query: str = "") -> str:
+        """
+        静态内容在前, 变化的查询内容在后
+        """
+        return f"{self.prefix}{self.suffix}{query}"
+
+def _shared_prefix(texts) -> str:
+    """
+    计算公共前缀, 并截断到最后一个换行符, 避免前缀在token中间断开
+    """
+    prefix = os.path.commonprefix(list(texts))
+    cut = prefix.rfind("\n")
+    return prefix[:cut + 1] if cut >= 0 else ""
+
+class PromptRegistry:
+    def __init__(self, prompt_path: Union[str, Path] = Path("./prompt.json")):
+        self.prompt_path = Path(prompt_path)
+        self._lock = threading.Lock()
+        self._mtime_ns = None
+        self._prompts: dict = {}
+        self._templates: Dict[Tuple[str, ...], Dict[str, PromptTemplate]] = {}
+
+    def _maybe_reload(self):
+        try:
+            mtime_ns = os.stat(self.prompt_path).st_mtime_ns
+        except FileNotFoundError:
+            logger.error(f"Prompt file {self.prompt_path} does not exist.")
+            raise FileNotFoundError(f"Prompt file {self.prompt_path} does not exist.")
+        if mtime_ns == self._mtime_ns:
+            return
+        with self._lock:
+            if mtime_ns == self._mtime_ns:
+                return
+            with open(self.prompt_path, 'r', encoding='utf-8') as file:
+                self._prompts = json.load(file)
+            self._templates = {}
+            self._mtime_ns = mtime_ns
+            logger.info(f"Prompt file {self.prompt_path} loaded.")
+
+    def _section(self, section: Tuple[str, ...]) -> Dict[str, PromptTemplate]:
+        templates = self._templates.get(section)
+        if templates is not None:
+            return templates
+
+        node = self._prompts
+        for key in section:
+            if not isinstance(node, dict) or key not in node:
+                logger.error(f"Prompt section {'.'.join(section)} not found.")
+                raise KeyError(f"Prompt section {'.'.join(section)} not found.")
+            node = node[key]
+        prefix = _shared_prefix(node.values()) if node else ""
+        templates = {subset: PromptTemplate(prefix, text[len(prefix):])
+                     for subset, text in node.items()}
+        self._templates[section] = templates
+        return templates
+
+    def get_template(self, section: Tuple[str, ...], subset: str) -> PromptTemplate:
+        """
+        :param section: 分组路径, 如 ("pre_retrieval", "queries") 或 ("generate",)
+        :param subset: 数据集子集名称
+        :return: PromptTemplate
+        """
+        self._maybe_reload()
+        templates = self._section(tuple(section))
+        if subset not in templates:
+            logger.error(f"Subset {subset} not found in prompts.")
+            raise KeyError(f"Subset {subset} not found in prompts.")
+        return templates[subset]
+
+    def get(self, section: Tuple[str, ...], subset: str) -> str:
+        return self.get_template(section, subset).text
+
+_REGISTRIES: Dict[str, PromptRegistry] = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+def get_registry(prompt_path: Union[str, Path] = Path("./prompt.json")) -> PromptRegistry:
+    """
+    获取进程内共享的注册表, 同一文件只有一个实例
+    """
+    key = os.path.abspath(prompt_path)
+    registry = _REGISTRIES.get(key)
+    if registry is None:
+        with _REGISTRIES_LOCK:
+            registry = _REGISTRIES.setdefault(key, PromptRegistry(prompt_path))
+    return registry
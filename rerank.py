@@ -1,9 +1,34 @@
 import requests
 import logging
-from typing import List
+import numpy as np
+from contextlib import nullcontext
+from typing import Callable, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from rerank_cache import RerankScoreCache
+import tracing
 
 logger = logging.getLogger(__name__)
 
+def _post_rerank(query: str, documents: List[str], api_key: str, url: str, top_n: int, model: str,
+                 timeout: float, return_documents: bool = True) -> Optional[dict]:
+    headers = {"Authorization": f"Bearer {api_key}",
+               "Content-Type": "application/json",
+               "Accept": "application/json"}
+    data = {"query": query, "documents": documents,
+            "return_documents": return_documents,
+            "raw_scores": True,
+            "model": model,
+            "top_n": top_n}
+    try:
+        with tracing.span("rerank_request", api="get_rerank"):
+            response = requests.post(url, json=data, headers=headers, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        logger.exception("rerank 请求失败: %s", e)
+        return None
+
 def get_rerank(query: str,
     documents: List[str],
     api_key: str,
@@ -11,24 +36,152 @@ def get_rerank(query: str,
     top_n: int = 1,
     model: str = "models/bge-reranker-large",
     timeout: float = 10.0,
+    cache: Optional[RerankScoreCache] = None,
     **kwargs) -> dict:
-    
-    if api_key or url is None:
+    """
+    :param cache: 分数缓存, 指定时只有未命中的文档会发送给服务端, 返回的结果由缓存与新的分数组合而成
+    :return: 服务端的响应 {"results": [{"index", "relevance_score", ...}]}, 失败为 None
+    """
+    if not api_key or url is None:
+        logger.error("API key or URL is not provided.")
+    if cache is None:
+        return _post_rerank(query, documents, api_key, url, top_n, model, timeout)
+
+    scores = cache.get_many(model, [(query, document) for document in documents])
+    missing = list(dict.fromkeys(document for document, score in zip(documents, scores) if score is None))
+    if missing:
+        response = _post_rerank(query, missing, api_key, url, len(missing), model, timeout,
+                                return_documents=False)
+        if response is None:
+            return None
+        new_scores = {missing[item["index"]]: item["relevance_score"] for item in response["results"]}
+        cache.set_many(model, [(query, document, score) for document, score in new_scores.items()])
+        scores = [score if score is not None else new_scores.get(document)
+                  for document, score in zip(documents, scores)]
+    results = [{"index": i, "relevance_score": score, "document": {"text": document}}
+               for i, (document, score) in enumerate(zip(documents, scores)) if score is not None]
+    results.sort(key=lambda item: item["relevance_score"], reverse=True)
+    return {"results": results[:top_n]}
+
+
+def _truncate(document: str, max_length: int, chars_per_token: int = 4) -> str:
+    """
+    按估计的token数截断文档, 超出 reranker 最大长度的部分服务端也会丢弃
+    """
+    max_chars = max_length * chars_per_token
+    return document if len(document) <= max_chars else document[:max_chars]
+
+def batch_rerank(pairs: List[Tuple[str, List[str]]],
+    api_key: str,
+    url: str,
+    model: str = "models/bge-reranker-large",
+    max_length: int = 512,
+    max_docs_per_request: int = 64,
+    max_workers: int = 4,
+    timeout: float = 30.0,
+    truncate: Optional[Callable[[str], str]] = None,
+    session: Optional[requests.Session] = None,
+    cache: Optional[RerankScoreCache] = None,
+    budget=None) -> List[np.ndarray]:
+    """
+    批量rerank多个 (query, candidates)
+    - 相同的查询合并为一组, 同一查询下重复的文档只打分一次
+    - 文档在发送前截断到 reranker 的最大长度
+    - 每个查询的文档按 max_docs_per_request 打包, 请求数 = sum(ceil(去重文档数 / max_docs_per_request))
+    - max_workers > 1 时并发发送请求
+    :param pairs: [(query, [doc1, doc2, ...]), ...]
+    :param max_length: reranker 最大token数
+    :param truncate: 自定义截断函数, 默认按4字符/token估计
+    :param cache: 分数缓存, 只有未命中的 query-document 对会发送给服务端
+    :param budget: 可选的 budget.RateBudget, 多个子集并发时共享的并发与速率上限
+    :return: 每个查询一个与 candidates 顺序一致的 raw score 数组, 请求失败的位置为 NaN
+    """
+    if not api_key or url is None:
         logger.error("API key or URL is not provided.")
+        raise ValueError("API key or URL is not provided.")
+    if truncate is None:
+        truncate = lambda document: _truncate(document, max_length)
+
+    # 文档去重: 截断后的文本 -> 全局编号
+    doc_ids, unique_docs = {}, []
+    # 查询去重: 查询文本 -> 需要打分的文档编号
+    query_docs = {}
+    pair_doc_ids = []
+    for query, documents in pairs:
+        ids = []
+        for document in documents:
+            text = truncate(document)
+            if text not in doc_ids:
+                doc_ids[text] = len(unique_docs)
+                unique_docs.append(text)
+            ids.append(doc_ids[text])
+        pair_doc_ids.append(ids)
+        query_docs.setdefault(query, {}).update(dict.fromkeys(ids))
 
+    scores = {}
+    if cache is not None:
+        keys = [(query, doc_id) for query, ids in query_docs.items() for doc_id in ids]
+        cached = cache.get_many(model, [(query, unique_docs[doc_id]) for query, doc_id in keys])
+        for key, score in zip(keys, cached):
+            if score is not None:
+                scores[key] = score
+
+    requests_to_send = []
+    for query, ids in query_docs.items():
+        ids = [doc_id for doc_id in ids if (query, doc_id) not in scores]
+        for start in range(0, len(ids), max_docs_per_request):
+            requests_to_send.append((query, ids[start:start + max_docs_per_request]))
+
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
     headers = {"Authorization": f"Bearer {api_key}",
                "Content-Type": "application/json",
                "Accept": "application/json"}
-    data = {"query": query, "documents": documents,
-            "return_documents": True,
-            "raw_scores": True,
-            "model": model,
-            "top_n": top_n}
+
+    def send(request):
+        query, ids = request
+        data = {"query": query, "documents": [unique_docs[i] for i in ids],
+                "return_documents": False,
+                "raw_scores": True,
+                "model": model,
+                "top_n": len(ids)}
+        try:
+            # 先取得预算再计时, 延迟中不包含排队等待预算的时间
+            with budget or nullcontext(), tracing.span("rerank_request", api="batch_rerank"):
+                response = session.post(url, json=data, headers=headers, timeout=timeout)
+            response.raise_for_status()
+            if tracing.is_enabled():
+                tracing.count("rerank_documents_total", len(ids))
+                tracing.count("rerank_bytes_sent_total", len(response.request.body or b""))
+                tracing.count("rerank_bytes_received_total", len(response.content))
+            return {ids[item["index"]]: item["relevance_score"]
+                    for item in response.json()["results"]}
+        except requests.exceptions.RequestException as e:
+            logger.exception("rerank 请求失败: %s", e)
+            return {}
+
     try:
-        response = requests.post(url, json=data, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.exception("rerank 请求失败: %s", e)
-        return None
+        if max_workers > 1 and len(requests_to_send) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(send, requests_to_send))
+        else:
+            results = [send(request) for request in requests_to_send]
+    finally:
+        if own_session:
+            session.close()
+    new_items = []
+    for (query, _), result in zip(requests_to_send, results):
+        for doc_id, score in result.items():
+            scores[(query, doc_id)] = score
+            new_items.append((query, unique_docs[doc_id], score))
+    if cache is not None:
+        cache.set_many(model, new_items)
 
+    logger.info(f"Reranked {len(pairs)} queries with {len(requests_to_send)} requests "
+                f"({len(unique_docs)} unique documents)")
+    return [np.array([scores.get((query, doc_id), np.nan) for doc_id in ids], dtype=np.float32)
+            for (query, _), ids in zip(pairs, pair_doc_ids)]
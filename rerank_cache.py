@@ -0,0 +1,95 @@
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from sqlite_cache import SQLiteCache
+
+logger = logging.getLogger(__name__)
+"""
+    Rerank 分数缓存
+    以 (model, hash(query), hash(document)) 为键保存 raw score
+    内存层为 LRU, 可选的磁盘层为 SQLite (见 sqlite_cache.SQLiteCache, 按最近访问时间淘汰),
+    调整检索阶段参数后重复的 query-document 对不再请求服务端
+"""
+
+class RerankScoreCache(SQLiteCache):
+    TABLE = "rerank_cache"
+    LABEL = "Rerank cache"
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rerank_cache (
+            key BLOB PRIMARY KEY,
+            score REAL NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        )
+    """
+
+    def __init__(self, max_memory_entries: int = 200000, db_path: Optional[str] = None,
+                 max_entries: Optional[int] = 5000000, evict_interval: int = 10000):
+        """
+        :param max_memory_entries: 内存LRU的最大条数
+        :param db_path: SQLite 文件路径, None 表示只使用内存
+        :param max_entries: 磁盘上的最大条数, 超过时按最近访问时间删除最旧的记录
+        :param evict_interval: 每写入多少条记录执行一次磁盘淘汰
+        """
+        self.max_memory_entries = max_memory_entries
+        self._memory: "OrderedDict[bytes, float]" = OrderedDict()
+        super().__init__(db_path, max_entries=max_entries, evict_interval=evict_interval)
+
+    @staticmethod
+    def make_key(model: str, query: str, document: str) -> bytes:
+        h = hashlib.blake2b(digest_size=24)
+        for part in (model, query, document):
+            h.update(hashlib.blake2b(part.encode("utf-8"), digest_size=16).digest())
+        return h.digest()
+
+    def _remember(self, key: bytes, score: float):
+        self._memory[key] = score
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model: str, pairs: List[Tuple[str, str]]) -> List[Optional[float]]:
+        """
+        :param pairs: [(query, document), ...]
+        :return: 与 pairs 顺序一致的分数, 未命中为 None
+        磁盘的访问时间只在从磁盘读取时更新, 内存命中不写磁盘
+        """
+        keys = [self.make_key(model, query, document) for query, document in pairs]
+        scores: List[Optional[float]] = [None] * len(keys)
+        with self._lock:
+            missing: Dict[bytes, List[int]] = {}
+            for i, key in enumerate(keys):
+                score = self._memory.get(key)
+                if score is not None:
+                    self._memory.move_to_end(key)
+                    scores[i] = score
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if missing and self._conn is not None:
+                found = []
+                for key, score in self._select_many("score", list(missing)):
+                    key = bytes(key)
+                    found.append(key)
+                    self._remember(key, score)
+                    for i in missing[key]:
+                        scores[i] = score
+                self._touch(found, time.time())
+            self._count(sum(1 for score in scores if score is not None), len(scores))
+        return scores
+
+    def set_many(self, model: str, items: List[Tuple[str, str, float]]):
+        """
+        :param items: [(query, document, score), ...]
+        """
+        if not items:
+            return
+        rows = [(self.make_key(model, query, document), float(score))
+                for query, document, score in items]
+        with self._lock:
+            for key, score in rows:
+                self._remember(key, score)
+        now = time.time()
+        self._insert_many([(key, score, now, now) for key, score in rows])
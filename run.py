@@ -4,12 +4,25 @@ This script is used to run the LangChain application with the specified configur
 
 import yaml
 import os
+import json
+import time
 import logging
 import rerank 
 import dotenv
+from concurrent.futures import ThreadPoolExecutor
 from langchain_openai import ChatOpenAI
-from pre_retrueval import pre_retrieve
-from utils import load_yaml_config
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from pre_retrueval import pre_retrieve, DEFAULT_SUBSETS
+from llm_cache import LLMCache
+from chunks import get_operator, chunk_corpus, make_chunk_pool
+from embedding import EmbeddingClient
+from embedding_store import EmbeddingStore
+from ingest import ingest_incremental, iter_chunks
+from bm25 import BM25Index
+from budget import RateBudget
+import tracing
+from manifest import Manifest, fingerprint
+from utils import load_yaml_config, iter_jsonl
 # 日志文件路径（可选）
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
@@ -43,6 +56,10 @@ reranker_config = load_yaml_config(config_files["reranker_config"])
 embedding_config = load_yaml_config(config_files["embedding_config"])
 milvus_config = load_yaml_config(config_files["milvus_config"])
 
+# 性能观测: 关闭时几乎没有开销, 开启后在运行结束时导出 JSON / Prometheus 文本
+tracing_config = model_config.get('tracing') or {}
+tracing.enable(tracing_config.get('enabled', False))
+
 # Initialize LLM model
 # TODO: 只有这一种调用方式吗？
 try:
@@ -51,20 +68,177 @@ except Exception as e:
     logger.error(f"Error loading .env file: {e}")
 if not os.getenv("Qwen-API-KEY"):
     raise ValueError("Qwen-API-KEY is not set in the environment variables.")
+# 多个子集并发运行时共享的请求预算
+# LLM: requests_per_second 通过 InMemoryRateLimiter 限速, max_concurrency 按并发子集数分摊
+llm_rate_limiter = None
+if model_config.get('requests_per_second'):
+    llm_rate_limiter = InMemoryRateLimiter(requests_per_second=model_config['requests_per_second'],
+                                           max_bucket_size=model_config.get('max_concurrency', 1))
 # config or Env Value？
 llm = ChatOpenAI(
     api_key=os.getenv("Qwen-API-KEY", model_config['Qwen-API-key']),
     base_url=os.getenv("Qwen-API-URL", model_config['url']),
     model_name=os.getenv("Qwen-API-MODEL", model_config['model']),
+    rate_limiter=llm_rate_limiter,
+    callbacks=[tracing.llm_callback_handler()] if tracing.is_enabled() else None,
 )
+# llm_cache: 缓存LLM响应, 重复运行时不再重复调用LLM
+cache_config = dict(model_config.get('llm_cache') or {})
+llm_cache = LLMCache(**cache_config) if cache_config.pop('enabled', True) else None
 
-# Run pre-retrieval process
-# 该方法指定了数据集。
-# v1 该方法只处理了查询扩展, expand_query_stream支持流式处理query
-pre_retrieve(dataset_path=model_config['dataPath'], llm=llm)
-
-# Run embeddings process
 # store embedding results in the milvus database
+# 分块 -> embedding -> 入库 流式执行, 见 ingest.py
+embedding_budget = RateBudget(max_concurrency=embedding_config.get('max_concurrency', 8),
+                              requests_per_second=embedding_config.get('requests_per_second'),
+                              name="embedding")
+embedding_client = EmbeddingClient(
+    url=os.getenv("Embedding-API-URL", embedding_config['url']),
+    api_key=os.getenv("Embedding-API-KEY", embedding_config.get('api_key')),
+    model=embedding_config.get('model', "models/bge-large-zh-v1.5"),
+    dimensions=embedding_config.get('dimensions', 1024),
+    pool_size=embedding_config.get('max_concurrency', 8),
+    budget=embedding_budget,
+)
+embedding_store = None
+if embedding_config.get('store_path'):
+    embedding_store = EmbeddingStore(embedding_config['store_path'],
+                                     model=embedding_client.model,
+                                     dimensions=embedding_client.dimensions)
+
+def make_chunk_operator():
+    # 算子实例可能带有状态 (如 MarkdownSplitter), 每个子集单独创建
+    return get_operator(embedding_config.get('chunk_operator', "langchain-structure-based"))(
+        **embedding_config.get('chunk_kwargs', {}))
+
+def get_vector_store(subset):
+    # backend: milvus 或 numpy (本地索引, 不需要Milvus服务)
+    if milvus_config.get('backend', "milvus") == "numpy":
+        from vector_index import NumpyVectorIndex
+        index_path = os.path.join(milvus_config.get('index_path', "index"), subset)
+        if os.path.exists(index_path):
+            # 增量入库需要在已有索引上更新
+            return NumpyVectorIndex.load(index_path, mmap=False)
+        return NumpyVectorIndex(dimensions=embedding_client.dimensions)
+    from milvus import get_connection_manager, MilvusVectorStore
+    return MilvusVectorStore(get_connection_manager(milvus_config.get('connection')),
+                             collection_name=f"{milvus_config.get('collection_prefix', 'financerag')}_{subset}",
+                             dimensions=embedding_client.dimensions)
+
+chunker = None
+chunk_pool = None
+if embedding_config.get('chunk_workers', 1) > 1:
+    # 分块是CPU密集型任务, 使用进程池并行
+    # 所有并发的子集共享一个进程池, 总进程数为 chunk_workers, 不随子集数增加
+    chunk_pool = make_chunk_pool(embedding_config.get('chunk_operator', "langchain-structure-based"),
+                                 embedding_config.get('chunk_kwargs', {}),
+                                 max_workers=embedding_config['chunk_workers'])
+    chunker = lambda docs: chunk_corpus(docs,
+                                        embedding_config.get('chunk_operator', "langchain-structure-based"),
+                                        embedding_config.get('chunk_kwargs', {}),
+                                        max_workers=embedding_config['chunk_workers'],
+                                        executor=chunk_pool)
+# 分块参数、embedding模型或向量库变化时全部重建
+ingest_fingerprint = fingerprint(embedding_config.get('chunk_operator', "langchain-structure-based"),
+                                 embedding_config.get('chunk_kwargs', {}),
+                                 embedding_client.model, embedding_client.dimensions,
+                                 milvus_config.get('backend', "milvus"),
+                                 milvus_config.get('collection_prefix', 'financerag'))
+
+def _count_lines(file_path):
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, "rb") as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+
+def run_subset(subset, llm_concurrency=1):
+    """
+    处理单个子集: 查询扩展与语料预处理 -> 分块、embedding、入库 -> BM25索引
+    :return: 子集的耗时与吞吐统计
+    """
+    summary = {"subset": subset, "status": "ok", "stages": {}}
+    start_time = time.perf_counter()
+    try:
+        # Run pre-retrieval process
+        # v1 该方法只处理了查询扩展, expand_query_stream支持流式处理query
+        stage_start = time.perf_counter()
+        with tracing.span("stage", stage="pre_retrieve", subset=subset):
+            failures = pre_retrieve(dataset_path=model_config['dataPath'], llm=llm,
+                                    max_concurrency=llm_concurrency, cache=llm_cache, subsets=[subset])
+        if subset in failures:
+            raise failures[subset]
+        summary["stages"]["pre_retrieve"] = time.perf_counter() - stage_start
+        summary["queries"] = _count_lines(os.path.join(model_config['dataPath'], subset, "queries.jsonl"))
+
+        # Run embeddings process
+        stage_start = time.perf_counter()
+        chunk_operator = make_chunk_operator()
+        vector_store = get_vector_store(subset)
+        corpus_path = os.path.join(model_config['dataPath'], subset, "corpus_prep.jsonl")
+        # 只对变化的文档重新分块、embedding、入库
+        # embedding_store 在并发的子集之间共享, 相同的分块文本只请求一次
+        with tracing.span("stage", stage="ingest", subset=subset):
+            stats = ingest_incremental(corpus_path, Manifest.for_subset(model_config['dataPath'], subset),
+                                       chunk_operator, embedding_client, vector_store,
+                                       fingerprint=ingest_fingerprint, chunker=chunker,
+                                       embedding_store=embedding_store)
+        if hasattr(vector_store, "save"):
+            vector_store.save(os.path.join(milvus_config.get('index_path', "index"), subset))
+        # BM25 关键词索引, 与稠密检索结果做 RRF 融合
+        if embedding_config.get('bm25_path'):
+            bm25_path = os.path.join(embedding_config['bm25_path'], subset)
+            if stats["inserted"] or stats["deleted"] or not os.path.exists(bm25_path):
+                docs = iter_jsonl(corpus_path)
+                records = chunker(docs) if chunker is not None else iter_chunks(docs, chunk_operator)
+                BM25Index.from_records(records).save(bm25_path)
+        summary["stages"]["ingest"] = time.perf_counter() - stage_start
+        summary.update({"chunks": stats["chunks"], "inserted": stats["inserted"], "deleted": stats["deleted"]})
+    except Exception as e:
+        logger.exception(f"Subset {subset} failed: {e}")
+        summary.update({"status": "failed", "error": str(e)})
+    summary["seconds"] = time.perf_counter() - start_time
+    for key in ("queries", "chunks"):
+        if summary.get(key) and summary["stages"]:
+            stage = "pre_retrieve" if key == "queries" else "ingest"
+            summary[f"{key}_per_second"] = summary[key] / max(summary["stages"].get(stage, 0.0), 1e-9)
+    logger.info(f"Subset {subset} {summary['status']} in {summary['seconds']:.1f}s")
+    return summary
+
+def main():
+    """
+    批量运行: 子集来自 model.yaml 的 subsets, 最多 subset_workers 个子集并发
+    所有子集共享 LLM / embedding 的请求预算, 结束后写出每个子集的耗时与吞吐
+    """
+    subsets = model_config.get('subsets') or DEFAULT_SUBSETS
+    subset_workers = max(1, min(model_config.get('subset_workers', 1), len(subsets)))
+    # 全局 LLM 并发按同时运行的子集数分摊
+    llm_concurrency = max(1, model_config.get('max_concurrency', 1) // subset_workers)
+    logger.info(f"Running {len(subsets)} subsets with {subset_workers} workers, "
+                f"LLM concurrency {llm_concurrency} per subset.")
 
+    start_time = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=subset_workers, thread_name_prefix="subset") as executor:
+            summaries = list(executor.map(lambda subset: run_subset(subset, llm_concurrency), subsets))
+    finally:
+        if chunk_pool is not None:
+            chunk_pool.shutdown()
 
+    output_path = model_config.get('output_path', "outputs")
+    os.makedirs(output_path, exist_ok=True)
+    summary = {"seconds": time.perf_counter() - start_time,
+               "subset_workers": subset_workers,
+               "embedding_budget": embedding_budget.report(),
+               "subsets": summaries}
+    with open(os.path.join(output_path, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    for item in summaries:
+        logger.info(f"{item['subset']}: {item['status']}, {item['seconds']:.1f}s, "
+                    f"{item.get('queries_per_second', 0):.1f} queries/s, "
+                    f"{item.get('chunks_per_second', 0):.1f} chunks/s")
+    logger.info(f"Summary saved to {os.path.join(output_path, 'summary.json')}")
+    if tracing.is_enabled():
+        tracing.export_json(tracing_config.get('json_path', os.path.join(output_path, "metrics.json")))
+        tracing.export_prometheus(tracing_config.get('prometheus_path', os.path.join(output_path, "metrics.prom")))
 
+if __name__ == "__main__":
+    main()
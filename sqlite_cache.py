@@ -0,0 +1,136 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+"""
+    基于 SQLite 的键值缓存基类, LLMCache 与 RerankScoreCache 共用
+    - WAL 模式, 多进程可共享同一个文件
+    - 批量查询按 900 个参数分段 (SQLite 默认最多 999 个绑定参数)
+    - 淘汰: max_age 按写入时间过期, max_entries 按最近访问时间删除最旧的记录
+    子类提供表名、建表语句与各自的读写方法, 表中需要 key / created_at / accessed_at 三列
+"""
+
+class SQLiteCache:
+    TABLE = None
+    _SCHEMA = None
+    LABEL = "Cache"
+
+    def __init__(self,
+                 db_path: Optional[str],
+                 max_entries: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 evict_interval: int = 1000):
+        """
+        :param db_path: SQLite 文件路径, None 表示不使用磁盘
+        :param max_entries: 磁盘上的最大记录数
+        :param max_age: 记录最长保存时间(秒)
+        :param evict_interval: 每写入多少条记录执行一次淘汰
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_evict = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path:
+            dirname = os.path.dirname(db_path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            # timeout: 其他进程持有写锁时等待, 而不是直接报错
+            self._conn = sqlite3.connect(db_path, timeout=30.0, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(self._SCHEMA)
+            self._migrate()
+            self._conn.commit()
+            self.evict()
+
+    def _migrate(self):
+        """
+        旧版本的表缺少 accessed_at 列时补上
+        """
+        columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({self.TABLE})")}
+        if "accessed_at" not in columns:
+            self._conn.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+
+    def _select_many(self, columns: str, keys: Sequence) -> List[tuple]:
+        """
+        需要在 self._lock 内调用
+        :return: SELECT key, <columns> 的所有行
+        """
+        rows = []
+        for start in range(0, len(keys), 900):
+            part = keys[start:start + 900]
+            placeholders = ",".join("?" * len(part))
+            rows.extend(self._conn.execute(
+                f"SELECT key, {columns} FROM {self.TABLE} WHERE key IN ({placeholders})", part).fetchall())
+        return rows
+
+    def _touch(self, keys: Sequence, now: float):
+        """
+        更新最近访问时间, 需要在 self._lock 内调用
+        """
+        if keys:
+            self._conn.executemany(f"UPDATE {self.TABLE} SET accessed_at = ? WHERE key = ?",
+                                   [(now, key) for key in keys])
+            self._conn.commit()
+
+    def _insert_many(self, rows: List[tuple]):
+        """
+        INSERT OR REPLACE 并按 evict_interval 触发淘汰
+        """
+        if self._conn is None or not rows:
+            return
+        placeholders = ",".join("?" * len(rows[0]))
+        with self._lock:
+            self._conn.executemany(f"INSERT OR REPLACE INTO {self.TABLE} VALUES ({placeholders})", rows)
+            self._conn.commit()
+            self._writes_since_evict += len(rows)
+            need_evict = self._writes_since_evict >= self.evict_interval
+        if need_evict:
+            self.evict()
+
+    def _count(self, hits: int, total: int):
+        self.hits += hits
+        self.misses += total - hits
+
+    def evict(self):
+        """
+        删除过期记录, 并将记录数控制在 max_entries 以内
+        """
+        if self._conn is None:
+            return
+        with self._lock:
+            if self.max_age is not None:
+                self._conn.execute(
+                    f"DELETE FROM {self.TABLE} WHERE created_at < ?", (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self._conn.execute(
+                    f"""DELETE FROM {self.TABLE} WHERE key IN (
+                        SELECT key FROM {self.TABLE} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                    )""", (self.max_entries,))
+            self._conn.commit()
+            self._writes_since_evict = 0
+
+    def report(self):
+        """
+        输出本进程的命中统计
+        """
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        location = f" {self.db_path}" if self.db_path else ""
+        logger.info(f"{self.LABEL}{location}: {self.hits} hits, {self.misses} misses (hit rate {rate:.1%})")
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": rate}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
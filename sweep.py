@@ -0,0 +1,206 @@
+"""
+分块参数扫描: 对 chunk_operator / chunk_size / chunk_overlap 的组合做网格搜索, 用 qrels 评估检索效果
+
+    - 分块: 所有组合共用一个进程池, 每个工作进程按参数缓存算子实例, 同时只分块 parallel 个组合
+    - embedding: 通过 EmbeddingStore 缓存, 各组合中相同的分块文本、重复运行都不会再次请求服务端
+    - 检索与评估: NumpyVectorIndex 精确检索 + evaluation.evaluate 矩阵化计算
+    - 多个组合并行: 分块在进程池中, embedding 与检索在线程中重叠执行, 内存占用与网格大小无关
+
+用法:
+    python sweep.py --subset FinQA --operators langchain-structure-based,markdown-splitter \\
+        --chunk-sizes 256,512,1024 --chunk-overlaps 0,51 --output outputs/sweep_FinQA.json
+embedding 服务的配置与 run.py 相同 (config/embedding.yaml, 环境变量 Embedding-API-URL / Embedding-API-KEY)
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional
+from chunks import get_operator, to_chunk_records
+from embedding import EmbeddingClient
+from embedding_store import EmbeddingStore
+from evaluation import evaluate, find_qrels, load_qrels, rank_documents
+from vector_index import NumpyVectorIndex
+from utils import iter_batches, iter_jsonl, load_yaml_config
+
+logger = logging.getLogger(__name__)
+
+_SWEEP_OPERATORS = {}
+
+def _chunk_with(operator_name: str, operator_kwargs: tuple, docs: List[dict]) -> List[dict]:
+    """
+    工作进程内按 (算子, 参数) 缓存算子实例
+    """
+    key = (operator_name, operator_kwargs)
+    operator = _SWEEP_OPERATORS.get(key)
+    if operator is None:
+        operator = _SWEEP_OPERATORS[key] = get_operator(operator_name)(**dict(operator_kwargs))
+    results = operator.execute_batch([doc["text"] for doc in docs])
+    return [record for doc, chunks in zip(docs, results) for record in to_chunk_records(doc, chunks)]
+
+def make_grid(operators: List[str], chunk_sizes: List[int], chunk_overlaps: List[int],
+              extra_kwargs: Optional[dict] = None) -> List[dict]:
+    """
+    :return: [{"operator": ..., "kwargs": {...}}, ...], 跳过 overlap >= size 的组合
+    markdown-splitter 按结构分块, 不使用 chunk_size / chunk_overlap, 只保留一个组合
+    """
+    grid, seen = [], set()
+    for operator, size, overlap in itertools.product(operators, chunk_sizes, chunk_overlaps):
+        if operator == "markdown-splitter":
+            kwargs = {}
+        elif operator == "table-splitter":
+            kwargs = {"chunk_size": size}
+        else:
+            if overlap >= size:
+                continue
+            kwargs = {"chunk_size": size, "chunk_overlap": overlap}
+        kwargs.update(extra_kwargs or {})
+        key = (operator, tuple(sorted(kwargs.items())))
+        if key not in seen:
+            seen.add(key)
+            grid.append({"operator": operator, "kwargs": kwargs})
+    return grid
+
+def run_sweep(docs: List[dict],
+              queries: List[dict],
+              qrels: Dict[str, Dict[str, float]],
+              grid: List[dict],
+              client: EmbeddingClient,
+              store: Optional[EmbeddingStore] = None,
+              chunk_workers: Optional[int] = None,
+              parallel: int = 2,
+              docs_per_task: int = 32,
+              top_k: int = 100,
+              embed_batch_size: int = 256) -> List[dict]:
+    """
+    :param docs: 语料记录
+    :param queries: 查询记录, 只评估 qrels 中的查询
+    :param grid: make_grid 的输出
+    :param client: embedding客户端
+    :param store: embedding缓存, 强烈建议指定; 各线程共享, 不同组合中相同的分块文本只请求一次
+    :param chunk_workers: 分块进程数, None 为CPU核数
+    :param parallel: 同时进行 分块/embedding/检索 的组合数, 决定内存中同时保留的分块结果数
+    :param top_k: 每个查询检索的分块数, 转为文档排序后评估
+    :return: 每个组合的指标, 按 nDCG@10 降序
+    """
+    def embed(texts: List[str]) -> np.ndarray:
+        parts = []
+        for batch in iter_batches(texts, embed_batch_size):
+            parts.append(store.embed(client, batch) if store is not None else client.embed(batch))
+        return np.concatenate(parts) if parts else np.empty((0, client.dimensions), dtype=np.float32)
+
+    queries = [query for query in queries if query["_id"] in qrels]
+    start_time = time.perf_counter()
+    query_vectors = embed([query["text"] for query in queries])
+    logger.info(f"Embedded {len(queries)} queries in {time.perf_counter() - start_time:.1f}s")
+
+    doc_batches = [docs[i:i + docs_per_task] for i in range(0, len(docs), docs_per_task)]
+    with ProcessPoolExecutor(max_workers=chunk_workers) as chunk_pool:
+        def evaluate_config(i: int) -> dict:
+            config = grid[i]
+            config_start = time.perf_counter()
+            # 分块任务在评估该组合时才提交, 内存中最多同时保留 parallel 个组合的分块结果
+            # 多个组合的任务共用进程池, 一个组合在 embedding 时其他组合的分块仍在进行
+            operator_kwargs = tuple(sorted(config["kwargs"].items()))
+            futures = [chunk_pool.submit(_chunk_with, config["operator"], operator_kwargs, batch)
+                       for batch in doc_batches]
+            records = [record for future in futures for record in future.result()]
+            del futures
+            chunk_seconds = time.perf_counter() - config_start
+
+            embed_start = time.perf_counter()
+            vectors = embed([record["text"] for record in records])
+            embed_seconds = time.perf_counter() - embed_start
+
+            index = NumpyVectorIndex(dimensions=client.dimensions)
+            index.upsert([record["id"] for record in records], vectors,
+                         [{"doc_id": record["metadata"]["doc_id"]} for record in records])
+            hits_list = index.search(query_vectors, top_k=top_k)
+            results = {query["_id"]: rank_documents(hits) for query, hits in zip(queries, hits_list)}
+            metrics = evaluate(results, qrels)
+            lengths = [len(record["text"]) for record in records]
+            result = {**config, **metrics,
+                      "chunks": len(records),
+                      "mean_chunk_chars": float(np.mean(lengths)) if lengths else 0.0,
+                      "seconds": {"chunk_wait": round(chunk_seconds, 3), "embed": round(embed_seconds, 3),
+                                  "total": round(time.perf_counter() - config_start, 3)}}
+            logger.info(f"{config['operator']} {config['kwargs']}: ndcg@10={metrics.get('ndcg@10', 0):.4f} "
+                        f"recall@100={metrics.get('recall@100', 0):.4f} chunks={len(records)}")
+            return result
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(evaluate_config, range(len(grid))))
+
+    results.sort(key=lambda result: result.get("ndcg@10", 0.0), reverse=True)
+    logger.info(f"Sweep of {len(grid)} configs finished in {time.perf_counter() - start_time:.1f}s")
+    return results
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="分块参数扫描")
+    parser.add_argument("--dataset-path", default=None, help="数据集路径, 默认使用 config/model.yaml 的 dataPath")
+    parser.add_argument("--subset", required=True, help="数据集子集名称")
+    parser.add_argument("--qrels", default=None, help="qrels 文件, 默认在子集目录中查找")
+    parser.add_argument("--expanded", action="store_true", help="使用 expanded_queries.jsonl")
+    parser.add_argument("--operators", default="langchain-structure-based")
+    parser.add_argument("--chunk-sizes", default="256,512,1024")
+    parser.add_argument("--chunk-overlaps", default="0,51")
+    parser.add_argument("--chunk-kwargs", default="{}", help="所有组合共用的其他算子参数 (JSON)")
+    parser.add_argument("--chunk-workers", type=int, default=None)
+    parser.add_argument("--parallel", type=int, default=2)
+    parser.add_argument("--top-k", type=int, default=100)
+    parser.add_argument("--store-path", default="cache/embeddings", help="embedding缓存路径, 空字符串表示不缓存")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+
+    embedding_config_path = os.path.join("config", "embedding.yaml")
+    # 也可以只通过环境变量配置 embedding 服务
+    embedding_config = (load_yaml_config(embedding_config_path) if os.path.exists(embedding_config_path) else None) or {}
+    dataset_path = args.dataset_path or load_yaml_config(os.path.join("config", "model.yaml"))['dataPath']
+    subset_path = os.path.join(dataset_path, args.subset)
+    qrels_path = args.qrels or find_qrels(dataset_path, args.subset)
+    if qrels_path is None:
+        raise FileNotFoundError(f"No qrels file found in {subset_path}, use --qrels.")
+
+    corpus_path = os.path.join(subset_path, "corpus_prep.jsonl")
+    if not os.path.exists(corpus_path):
+        corpus_path = os.path.join(subset_path, "corpus.jsonl")
+    docs = list(iter_jsonl(corpus_path))
+    queries = list(iter_jsonl(os.path.join(subset_path,
+                                           "expanded_queries.jsonl" if args.expanded else "queries.jsonl")))
+    qrels = load_qrels(qrels_path)
+
+    client = EmbeddingClient(
+        url=os.getenv("Embedding-API-URL", embedding_config.get('url')),
+        api_key=os.getenv("Embedding-API-KEY", embedding_config.get('api_key')),
+        model=embedding_config.get('model', "models/bge-large-zh-v1.5"),
+        dimensions=embedding_config.get('dimensions', 1024),
+        pool_size=args.parallel,
+    )
+    store = None
+    if args.store_path:
+        store = EmbeddingStore(args.store_path, model=client.model, dimensions=client.dimensions)
+
+    grid = make_grid(args.operators.split(","), _int_list(args.chunk_sizes), _int_list(args.chunk_overlaps),
+                     json.loads(args.chunk_kwargs))
+    logger.info(f"Sweeping {len(grid)} configs over {len(docs)} docs and {len(qrels)} judged queries.")
+    results = run_sweep(docs, queries, qrels, grid, client, store,
+                        chunk_workers=args.chunk_workers, parallel=args.parallel, top_k=args.top_k)
+    client.close()
+
+    report = {"subset": args.subset, "qrels": qrels_path, "results": results}
+    output = args.output or os.path.join("outputs", f"sweep_{args.subset}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logger.info(f"Sweep results saved to {output}")
+
+if __name__ == "__main__":
+    main()
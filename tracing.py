@@ -0,0 +1,278 @@
+import time
+import json
+import logging
+import functools
+import threading
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+"""
+    轻量的性能观测
+    - span: 计时区间, 记录调用次数、错误次数与延迟直方图
+    - count: 计数器, 如请求数、token数、字节数
+    - 导出为 JSON 摘要或 Prometheus 文本格式
+    默认关闭, 关闭时 span 返回共享的空上下文, traced 只多一次全局变量判断
+    工作进程中的记录通过 drain / merge 带回主进程, 如 chunks.chunk_corpus
+
+    用法:
+        tracing.enable()
+        with tracing.span("vector_search", backend="numpy"):
+            ...
+        @tracing.traced("embedding_request")
+        def get_embedding(...): ...
+        tracing.export_prometheus("logs/metrics.prom")
+"""
+
+PREFIX = "frag"
+# 延迟直方图的桶上界 (秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_ENABLED = False
+_LOCK = threading.Lock()
+_COUNTERS: Dict[Tuple[str, Tuple], float] = {}
+_HISTOGRAMS: Dict[Tuple[str, Tuple], "Histogram"] = {}
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        按桶估计分位数, 返回所在桶的上界
+        """
+        if self.count == 0:
+            return 0.0
+        target, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+def enable(flag: bool = True):
+    global _ENABLED
+    _ENABLED = flag
+
+def is_enabled() -> bool:
+    return _ENABLED
+
+def reset():
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+
+def drain() -> Optional[dict]:
+    """
+    取出并清空当前进程记录的数据, 用于把工作进程中的记录带回主进程 (见 merge)
+    :return: 可序列化的快照, 关闭时为 None
+    """
+    if not _ENABLED:
+        return None
+    with _LOCK:
+        snapshot = {"counters": dict(_COUNTERS),
+                    "histograms": {key: (h.buckets, h.counts, h.sum, h.count, h.max)
+                                   for key, h in _HISTOGRAMS.items()}}
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+    return snapshot
+
+def merge(snapshot: Optional[dict]):
+    """
+    合并 drain 得到的快照
+    """
+    if not _ENABLED or not snapshot:
+        return
+    with _LOCK:
+        for key, value in snapshot["counters"].items():
+            _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+        for key, (buckets, counts, total, n, maximum) in snapshot["histograms"].items():
+            histogram = _HISTOGRAMS.get(key)
+            if histogram is None:
+                histogram = _HISTOGRAMS[key] = Histogram(buckets)
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += n
+            histogram.max = max(histogram.max, maximum)
+
+def _key(name: str, labels: dict) -> Tuple[str, Tuple]:
+    return name, tuple(sorted(labels.items()))
+
+def count(name: str, value: float = 1, **labels):
+    if not _ENABLED:
+        return
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    if not _ENABLED:
+        return
+    key = _key(name, labels)
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = Histogram()
+        histogram.observe(value)
+
+class _Span:
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(f"{self.name}_seconds", time.perf_counter() - self.start, **self.labels)
+        count(f"{self.name}_calls_total", **self.labels)
+        if exc_type is not None:
+            count(f"{self.name}_errors_total", **self.labels)
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopSpan()
+
+def span(name: str, **labels):
+    """
+    计时区间, 关闭时返回共享的空上下文
+    """
+    if not _ENABLED:
+        return _NOOP
+    return _Span(name, labels)
+
+def traced(name: str, **labels):
+    """
+    为函数添加计时区间的装饰器
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return fn(*args, **kwargs)
+            with _Span(name, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# ===== LLM =====
+def llm_callback_handler():
+    """
+    langchain 回调: 记录每次 LLM 调用 (invoke / ainvoke / abatch) 的延迟、错误与 token 用量
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TracingCallbackHandler(BaseCallbackHandler):
+        def __init__(self):
+            self._starts = {}
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            self._starts[run_id] = time.perf_counter()
+
+        def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+            self._starts[run_id] = time.perf_counter()
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            start = self._starts.pop(run_id, None)
+            if start is not None:
+                observe("llm_request_seconds", time.perf_counter() - start)
+            count("llm_requests_total")
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            count("llm_prompt_tokens_total", usage.get("prompt_tokens", 0))
+            count("llm_completion_tokens_total", usage.get("completion_tokens", 0))
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._starts.pop(run_id, None)
+            count("llm_errors_total")
+
+    return TracingCallbackHandler()
+
+# ===== 导出 =====
+def _labels_dict(labels: Tuple) -> dict:
+    return {key: str(value) for key, value in labels}
+
+def summary() -> dict:
+    """
+    :return: {"counters": [...], "histograms": [...]}, 直方图附带均值与分位数估计
+    """
+    with _LOCK:
+        counters = [{"name": name, "labels": _labels_dict(labels), "value": value}
+                    for (name, labels), value in sorted(_COUNTERS.items())]
+        histograms = []
+        for (name, labels), h in sorted(_HISTOGRAMS.items(), key=lambda item: item[0]):
+            histograms.append({"name": name, "labels": _labels_dict(labels), "count": h.count,
+                               "sum": h.sum, "mean": h.sum / h.count if h.count else 0.0,
+                               "p50": h.quantile(0.5), "p95": h.quantile(0.95), "p99": h.quantile(0.99),
+                               "max": h.max})
+    return {"counters": counters, "histograms": histograms}
+
+def export_json(path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary(), f, ensure_ascii=False, indent=2)
+    logger.info(f"Metrics saved to {path}")
+
+def _format_labels(labels: Tuple, extra: Optional[Tuple] = None) -> str:
+    items = list(labels) + list(extra or ())
+    if not items:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + "}"
+
+def prometheus_text() -> str:
+    lines = []
+    with _LOCK:
+        counters = sorted(_COUNTERS.items())
+        histograms = sorted(_HISTOGRAMS.items(), key=lambda item: item[0])
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{PREFIX}_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for (name, labels), h in histograms:
+            metric = f"{PREFIX}_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            cumulative = 0
+            for bound, n in zip(h.buckets, h.counts):
+                cumulative += n
+                lines.append(f"{metric}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, (('le', '+Inf'),))} {h.count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {h.sum}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+def export_prometheus(path: str):
+    """
+    Prometheus 文本格式, 可由 node_exporter 的 textfile collector 采集
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text())
+    logger.info(f"Metrics saved to {path}")
@@ -18,3 +18,88 @@ def load_yaml_config(file_path: str):
         except yaml.YAMLError as e:
             logger.error(f"Failed to parse YAML file {file_path}: {e}")
             raise yaml.YAMLError(f"Failed to parse YAML file {file_path}: {e}")
+
+# ================
+# JSONL 流式读写
+# ================
+# orjson 可选, 未安装时回退到标准库 json
+try:
+    import orjson
+
+    def _json_loads(line: bytes):
+        return orjson.loads(line)
+
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def _json_loads(line: bytes):
+        return json.loads(line)
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+# 供其他模块复用的 JSON 编解码函数
+json_loads = _json_loads
+json_dumps = _json_dumps
+
+def iter_jsonl(file_path):
+    """
+    逐行读取jsonl文件, 内存占用与文件大小无关
+    :param file_path: jsonl文件路径
+    :return: 生成器, 每次返回一条记录
+    """
+    if not os.path.exists(file_path):
+        logger.error(f"File {file_path} does not exist.")
+        raise FileNotFoundError(f"File {file_path} does not exist.")
+
+    with open(file_path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield _json_loads(line)
+
+def iter_batches(iterable, batch_size: int):
+    """
+    将可迭代对象按 batch_size 切分为列表, 最后一批可能不足 batch_size
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class JsonlWriter:
+    """
+    增量写入jsonl文件, 每条记录写入后不在内存中保留
+    mode="w" 覆盖写, mode="a" 追加写
+    """
+    def __init__(self, file_path, mode: str = "w", buffering: int = 1 << 20):
+        if mode not in ("w", "a"):
+            raise ValueError(f"Unsupported mode: {mode}")
+        self.file_path = file_path
+        self._file = open(file_path, mode + "b", buffering=buffering)
+        self.count = 0
+
+    def write(self, obj):
+        self._file.write(_json_dumps(obj))
+        self._file.write(b"\n")
+        self.count += 1
+
+    def write_all(self, objs):
+        for obj in objs:
+            self.write(obj)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,293 @@
+import os
+import json
+import logging
+import numpy as np
+from typing import List, Optional
+import tracing
+
+logger = logging.getLogger(__name__)
+"""
+    进程内的向量索引, 可替代 Milvus 用于小规模子集实验和离线测试
+    - 精确检索: 归一化后矩阵乘法计算余弦相似度, 按批处理查询
+    - IVF: 可选的 k-means 分区, 只在 nprobe 个最近的分区中检索
+    - 持久化为 .npy 文件, 加载时通过 mmap 映射, 无需等待
+"""
+
+class BaseVectorStore:
+    """
+    向量存储的统一检索接口
+    search 返回: 每个查询一个列表 [{"id": ..., "score": ..., "metadata": {...}}, ...], 按分数降序
+    """
+    def upsert(self, ids: List[str], vectors: np.ndarray, metadata: Optional[List[dict]] = None):
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def search(self, query_vectors: np.ndarray, top_k: int = 10) -> List[List[dict]]:
+        raise NotImplementedError("Subclasses should implement this method.")
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _top_k(scores: np.ndarray, k: int):
+    """
+    对每一行取分数最高的k个, 返回 (下标, 分数), 按分数降序
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return (np.empty((scores.shape[0], 0), dtype=np.int64),
+                np.empty((scores.shape[0], 0), dtype=np.float32))
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+class NumpyVectorIndex(BaseVectorStore):
+    def __init__(self, dimensions: int = 1024, block_size: int = 1 << 24):
+        """
+        :param dimensions: 向量维度
+        :param block_size: 单次矩阵乘法的最大元素数 (查询数 x 向量数), 控制峰值内存
+        """
+        self.dimensions = dimensions
+        self.block_size = block_size
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        # 向量、删除标记与 IVF 分区保存在按倍数扩容的缓冲区中, 前 _size 行有效, 追加时均摊 O(1)
+        self._buffer = np.empty((0, dimensions), dtype=np.float32)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._assignments: Optional[np.ndarray] = None
+        self._size = 0
+        self._row = {}
+        # IVF
+        self.centroids: Optional[np.ndarray] = None
+        self._lists: Optional[List[np.ndarray]] = None
+
+    def __len__(self):
+        return len(self.ids) - int(self.deleted.sum())
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._buffer[:self._size]
+
+    @vectors.setter
+    def vectors(self, value: np.ndarray):
+        self._buffer = value
+        self._size = len(value)
+
+    @property
+    def deleted(self) -> np.ndarray:
+        return self._deleted[:self._size]
+
+    @deleted.setter
+    def deleted(self, value: np.ndarray):
+        self._deleted = value
+
+    @property
+    def assignments(self) -> Optional[np.ndarray]:
+        return self._assignments[:self._size] if self._assignments is not None else None
+
+    @assignments.setter
+    def assignments(self, value: Optional[np.ndarray]):
+        self._assignments = value
+
+    def _reserve(self, n: int):
+        """
+        保证向量、删除标记与分区缓冲区都至少能容纳 n 行, 容量不足时翻倍
+        mmap 加载的只读数组在这里复制到内存
+        """
+        arrays = [self._buffer, self._deleted] + ([self._assignments] if self._assignments is not None else [])
+        if all(len(array) >= n and array.flags.writeable for array in arrays):
+            return
+        capacity = max(n, 2 * len(self._buffer), 1024)
+
+        def grow(array: np.ndarray) -> np.ndarray:
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            return grown
+        self._buffer = grow(self._buffer)
+        self._deleted = grow(self._deleted)
+        if self._assignments is not None:
+            self._assignments = grow(self._assignments)
+
+    def upsert(self, ids: List[str], vectors: np.ndarray, metadata: Optional[List[dict]] = None):
+        """
+        插入或更新向量, 已存在的id原地覆盖
+        """
+        vectors = _normalize(vectors)
+        if vectors.shape != (len(ids), self.dimensions):
+            raise ValueError(f"Expected vectors of shape {(len(ids), self.dimensions)}, "
+                             f"got {vectors.shape}.")
+        if metadata is None:
+            metadata = [{} for _ in ids]
+        # 同一批中重复的id只保留最后一条
+        last = {_id: i for i, _id in enumerate(ids)}
+        if len(last) < len(ids):
+            keep = sorted(last.values())
+            ids, vectors, metadata = [ids[i] for i in keep], vectors[keep], [metadata[i] for i in keep]
+
+        self._reserve(self._size)
+
+        new_rows = []
+        for i, _id in enumerate(ids):
+            row = self._row.get(_id)
+            if row is None:
+                new_rows.append(i)
+                continue
+            self.vectors[row] = vectors[i]
+            self.metadata[row] = metadata[i]
+            self.deleted[row] = False
+            if self.centroids is not None:
+                self.assignments[row] = self._assign(vectors[i:i + 1])[0]
+
+        if new_rows:
+            start = len(self.ids)
+            for offset, i in enumerate(new_rows):
+                self._row[ids[i]] = start + offset
+                self.ids.append(ids[i])
+                self.metadata.append(metadata[i])
+            end = start + len(new_rows)
+            self._reserve(end)
+            self._buffer[start:end] = vectors[new_rows]
+            self._deleted[start:end] = False
+            if self.centroids is not None:
+                self._assignments[start:end] = self._assign(vectors[new_rows])
+            self._size = end
+        self._lists = None
+
+    def delete(self, ids: List[str]):
+        """
+        标记删除, 保存时压缩
+        """
+        for _id in ids:
+            row = self._row.get(_id)
+            if row is not None:
+                self.deleted[row] = True
+
+    # ===== IVF =====
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def build_ivf(self, nlist: int = 256, n_iter: int = 10, sample_size: int = 100000, seed: int = 0):
+        """
+        球面 k-means 划分向量空间
+        :param nlist: 分区数量, 一般取 sqrt(n) 左右
+        :param n_iter: 迭代次数
+        :param sample_size: 用于训练的采样数量
+        """
+        rng = np.random.default_rng(seed)
+        valid = np.flatnonzero(~self.deleted)
+        nlist = min(nlist, len(valid))
+        if nlist == 0:
+            logger.warning("Index is empty, skip building IVF.")
+            return
+        sample = self.vectors[rng.choice(valid, size=min(sample_size, len(valid)), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=nlist) == 0
+            # 空分区保留原中心
+            sums[empty] = centroids[empty]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+        self.assignments = np.empty(len(self.ids), dtype=np.int32)
+        for start in range(0, len(self.ids), 65536):
+            self.assignments[start:start + 65536] = self._assign(self.vectors[start:start + 65536])
+        self._lists = None
+        logger.info(f"IVF built with {nlist} lists over {len(valid)} vectors.")
+
+    def _inverted_lists(self) -> List[np.ndarray]:
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            bounds = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+        return self._lists
+
+    # ===== 检索 =====
+    @tracing.traced("vector_search", backend="numpy")
+    def search(self, query_vectors: np.ndarray, top_k: int = 10, nprobe: Optional[int] = None) -> List[List[dict]]:
+        """
+        :param query_vectors: shape=(n, dimensions) 或 (dimensions,)
+        :param top_k: 每个查询返回的数量
+        :param nprobe: 使用IVF时检索的分区数, None 表示精确检索
+        """
+        queries = _normalize(query_vectors)
+        if nprobe is not None and self.centroids is not None:
+            return self._search_ivf(queries, top_k, nprobe)
+
+        results = []
+        n = len(self.ids)
+        block = max(1, self.block_size // max(n, 1))
+        for start in range(0, len(queries), block):
+            scores = queries[start:start + block] @ self.vectors.T
+            if self.deleted.any():
+                scores[:, self.deleted] = -np.inf
+            idx, top = _top_k(scores, top_k)
+            for row_idx, row_scores in zip(idx, top):
+                results.append(self._format(row_idx, row_scores))
+        return results
+
+    def _search_ivf(self, queries: np.ndarray, top_k: int, nprobe: int) -> List[List[dict]]:
+        lists = self._inverted_lists()
+        probe_idx, _ = _top_k(queries @ self.centroids.T, nprobe)
+        results = []
+        for query, probes in zip(queries, probe_idx):
+            candidates = np.concatenate([lists[p] for p in probes])
+            if self.deleted.any():
+                candidates = candidates[~self.deleted[candidates]]
+            scores = self.vectors[candidates] @ query
+            idx, top = _top_k(scores[None, :], top_k)
+            results.append(self._format(candidates[idx[0]], top[0]))
+        return results
+
+    def _format(self, rows, scores) -> List[dict]:
+        return [{"id": self.ids[row], "score": float(score), "metadata": self.metadata[row]}
+                for row, score in zip(rows, scores) if np.isfinite(score)]
+
+    # ===== 持久化 =====
+    def save(self, path: str):
+        """
+        压缩已删除的行后保存
+        """
+        os.makedirs(path, exist_ok=True)
+        keep = np.flatnonzero(~self.deleted)
+        np.save(os.path.join(path, "vectors.npy"), np.ascontiguousarray(self.vectors[keep]))
+        with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump({"dimensions": self.dimensions,
+                       "ids": [self.ids[i] for i in keep],
+                       "metadata": [self.metadata[i] for i in keep]}, f, ensure_ascii=False)
+        if self.centroids is not None:
+            np.save(os.path.join(path, "centroids.npy"), self.centroids)
+            np.save(os.path.join(path, "assignments.npy"), self.assignments[keep])
+        logger.info(f"Vector index saved to {path} ({len(keep)} vectors).")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "NumpyVectorIndex":
+        """
+        :param mmap: True 时向量通过 mmap 只读映射, 加载几乎不耗时
+        """
+        if not os.path.exists(os.path.join(path, "ids.json")):
+            logger.error(f"Vector index {path} does not exist.")
+            raise FileNotFoundError(f"Vector index {path} does not exist.")
+        with open(os.path.join(path, "ids.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(dimensions=meta["dimensions"])
+        index.ids = meta["ids"]
+        index.metadata = meta["metadata"]
+        index._row = {_id: i for i, _id in enumerate(index.ids)}
+        index.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        index.deleted = np.zeros(len(index.ids), dtype=bool)
+        if os.path.exists(os.path.join(path, "centroids.npy")):
+            index.centroids = np.load(os.path.join(path, "centroids.npy"))
+            index.assignments = np.load(os.path.join(path, "assignments.npy"))
+        return index